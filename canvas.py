@@ -0,0 +1,68 @@
+import weakref
+
+import cv2
+import numpy as np
+import pygame
+
+
+class FrameCanvas:
+    # Drawing target with the part of the pygame.Surface interface the renderer uses, drawing straight into a BGR
+    # frame for the video encoders.  Sources are pygame surfaces, converted once and blended the same way pygame
+    # blits per-pixel alpha onto a surface without alpha.
+    def __init__(self, width, height):
+        self.frame = np.zeros((height, width, 3), dtype=np.uint8)
+        self.clip = self.get_rect()
+        self.sprites = weakref.WeakKeyDictionary()
+
+    def get_size(self):
+        return self.frame.shape[1], self.frame.shape[0]
+
+    def get_rect(self):
+        return pygame.Rect((0, 0), self.get_size())
+
+    def set_clip(self, rect):
+        self.clip = self.get_rect() if rect is None else self.get_rect().clip(rect)
+
+    def blit(self, source, dest):
+        pixels, mask, weighted, inverse_alpha = self.sprite(source)
+        # pygame truncates float positions
+        x = int(dest[0])
+        y = int(dest[1])
+        target = pygame.Rect(x, y, pixels.shape[1], pixels.shape[0]).clip(self.clip)
+        if target.width == 0 or target.height == 0:
+            return target
+
+        area = (slice(target.top - y, target.bottom - y), slice(target.left - x, target.right - x))
+        dst = self.frame[target.top:target.bottom, target.left:target.right]
+        if weighted is not None:
+            # pygame's dst + ((src - dst) * a + src >> 8), as (src * (a + 1) + dst * (256 - a)) / 256 rounded down.
+            # Every term is an exact float, and the offset makes rounding to nearest round down.
+            blended = cv2.multiply(dst, inverse_alpha[area], dtype=cv2.CV_32F)
+            cv2.add(blended, weighted[area], dst=blended)
+            cv2.convertScaleAbs(blended, dst, 1 / 256, -127.5 / 256)
+        elif mask is not None:
+            cv2.copyTo(pixels[area], mask[area], dst)
+        else:
+            dst[...] = pixels[area]
+        return target
+
+    def sprite(self, source):
+        # BGR pixels of a surface, with a mask of the opaque pixels if the others are fully transparent, or the
+        # terms of the alpha blending if some pixels are translucent
+        sprite = self.sprites.get(source)
+        if sprite is None:
+            pixels = np.ascontiguousarray(pygame.surfarray.array3d(source).transpose(1, 0, 2)[:, :, ::-1])
+            mask = None
+            weighted = None
+            inverse_alpha = None
+            if source.get_flags() & pygame.SRCALPHA:
+                alpha = pygame.surfarray.array_alpha(source).T
+                if ((alpha != 0) & (alpha != 255)).any():
+                    alpha = np.repeat(alpha[:, :, np.newaxis], 3, axis=2).astype(np.float32)
+                    weighted = pixels * (alpha + 1)
+                    inverse_alpha = 256 - alpha
+                elif (alpha == 0).any():
+                    mask = (alpha == 255).astype(np.uint8)
+            sprite = (pixels, mask, weighted, inverse_alpha)
+            self.sprites[source] = sprite
+        return sprite
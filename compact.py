@@ -0,0 +1,53 @@
+import argparse
+import os
+
+import recorder
+from telemetry_cache import connect_read_only
+
+
+def compact(source, destination, packet_filter):
+    # Copies the packets packet_filter keeps to a new recording, with their original ids
+    conn = connect_read_only(source)
+    query = f"SELECT {recorder.COLUMNS} FROM packets"
+    params = []
+    if packet_filter.packet_ids is not None:
+        params = sorted(packet_filter.packet_ids)
+        query += f" WHERE packetId IN ({', '.join('?' * len(params))})"
+    cursor = conn.execute(query + " ORDER BY pkt_id;", params)
+
+    # An interrupted run never leaves a partial recording behind
+    tmp_destination = f"{destination}.{os.getpid()}.tmp"
+    writer = recorder.PacketWriter(tmp_destination)
+    try:
+        batch = cursor.fetchmany(recorder.WRITE_BATCH_SIZE)
+        while batch:
+            writer.write([row for row in batch if packet_filter.keep(row[6])])
+            batch = cursor.fetchmany(recorder.WRITE_BATCH_SIZE)
+        writer.close()
+        os.replace(tmp_destination, destination)
+    finally:
+        conn.close()
+        if os.path.exists(tmp_destination):
+            writer.conn.close()
+            os.remove(tmp_destination)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Rewrite an F1 2020 recording with only the packets to keep.")
+    parser.add_argument("session", help="SQLite3 file recorded from the game's telemetry")
+    parser.add_argument("output", help="compacted SQLite3 file to write")
+    recorder.add_filter_args(parser)
+    args = parser.parse_args()
+    if os.path.exists(args.output):
+        parser.error(f"{args.output} already exists")
+    return args
+
+
+def run():
+    args = parse_args()
+    compact(args.session, args.output, recorder.packet_filter(args))
+    print(f"{os.path.getsize(args.session)} -> {os.path.getsize(args.output)} bytes")
+
+
+if __name__ == "__main__":
+    run()
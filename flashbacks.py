@@ -0,0 +1,57 @@
+class FlashbackEntry:
+    def __init__(self, pkt_id, result_status, lap_number, current_lap_time):
+        self.pkt_id = pkt_id
+        self.result_status = result_status
+        self.lap_number = lap_number
+        self.current_lap_time = current_lap_time
+        self.next_pkt_id = None
+
+
+class FlashbackDetector:
+    # A flashback shows up as a lap data packet that is behind the packets received just before it.  Packets
+    # that are ahead of a later packet can never end a flashback again, so they are dropped from a monotonic
+    # stack and every packet is compared against a handful of entries at most.
+    def __init__(self):
+        self.stack = []
+        self.first_pkt_id = None
+        self.flashbacks = []
+
+    def add(self, pkt_id, result_status, lap_number, current_lap_time):
+        entry = FlashbackEntry(pkt_id, result_status, lap_number, current_lap_time)
+        if self.first_pkt_id is None:
+            self.first_pkt_id = pkt_id
+        if len(self.stack) > 0:
+            self.stack[-1].next_pkt_id = pkt_id
+
+        popped = False
+        while len(self.stack) > 0 and self.is_flashback(self.stack[-1], entry):
+            self.stack.pop()
+            popped = True
+
+        if popped:
+            # Everything received after the last packet that is still behind this one gets excluded
+            start_pkt_id = self.stack[-1].next_pkt_id if len(self.stack) > 0 else self.first_pkt_id
+            self.flashbacks.append((start_pkt_id, pkt_id))
+        self.stack.append(entry)
+
+    @staticmethod
+    def is_flashback(previous, current):
+        for i in range(len(current.lap_number)):
+            if current.result_status[i] == 2 and previous.result_status[i] == 2:
+                if current.lap_number[i] < previous.lap_number[i] or \
+                        current.lap_number[i] == previous.lap_number[i] and \
+                        current.current_lap_time[i] < previous.current_lap_time[i]:
+                    return True
+                else:
+                    return False
+        return False
+
+
+def merge_ranges(ranges):
+    merged = []
+    for (start, end) in sorted(ranges):
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [(start, end) for (start, end) in merged]
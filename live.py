@@ -0,0 +1,300 @@
+import argparse
+import asyncio
+import ctypes
+import sys
+import time
+
+import numpy as np
+import pygame.locals
+from f1_2020_telemetry import packets
+
+import render
+import state
+import video
+from render import WINDOW_HEIGHT, WINDOW_WIDTH, FPS
+from replay import TELEMETRY_PORT
+from session import CarInfo, FastestLapInfo, FinalClassification, Session, SessionIndex, get_top_running_car
+from telemetry_cache import LAP_FIELDS, LAP_PACKET_DTYPE, EventRecord, TelemetryCache
+from track_speed import SpinDetector
+
+# Race and second race, other sessions are ignored
+RACE_SESSION_TYPES = (10, 11)
+# How long the viewer keeps showing the results after the session ends
+POST_RACE_SECONDS = 10
+
+
+class LapDataPacket:
+    # Same fields as a LapDataRow, decoded straight from a lap data packet
+    def __init__(self, data):
+        lap_data = np.frombuffer(data, dtype=LAP_PACKET_DTYPE)[0]["lapData"]
+        for name, field in LAP_FIELDS.items():
+            setattr(self, name, lap_data[field].tolist())
+
+    def __repr__(self):
+        return str(vars(self))
+
+
+class LiveSession(Session):
+    # Session fed with the packets the game sends during a race, instead of a recording.  The session index grows
+    # with every packet and the race position follows the latest lap data, so the Session methods that only read
+    # those work unchanged.
+    def __init__(self, driver_filename):
+        self.index = SessionIndex()
+        self.driver_names = self.load_driver_names(driver_filename)
+
+        self.safety_car_status = 0
+        self.fastest_lap_info = None
+        self.race_position = None
+        self.chequered_flag = False
+        self.finished = False
+        # Created once the track and the cars are known
+        self.spin_detector = None
+
+        self.laps = []
+        self.num_laps = None
+
+        # The first race session seen is the one followed
+        self.session_uid = None
+        self.pkt_id = 0
+        self.ready = asyncio.Event()
+
+    def get_final_classification(self):
+        if self.index.final_classification is None:
+            return None
+        return list(self.index.final_classification)
+
+    def add_packet(self, data):
+        # Only the header is decoded for the packets the viewer does not use
+        if len(data) < ctypes.sizeof(packets.PacketHeader):
+            return
+        header = packets.PacketHeader.from_buffer_copy(data)
+        if header.packetId not in (1, 2, 3, 4, 8):
+            return
+        try:
+            packet = packets.unpack_udp_packet(data)
+        except packets.UnpackError:
+            return
+
+        if self.session_uid is None:
+            if header.packetId != 1 or packet.sessionType not in RACE_SESSION_TYPES:
+                return
+            self.session_uid = header.sessionUID
+            # In case the viewer was started after the race started, laps are counted from the first packets
+            self.index.current_lap = 0
+        elif header.sessionUID != self.session_uid:
+            return
+
+        self.pkt_id += 1
+        index = self.index
+        if header.packetId == 1:
+            if index.track_length is None:
+                index.track_length = packet.trackLength
+                index.num_laps = packet.totalLaps
+                self.num_laps = packet.totalLaps
+            self.safety_car_status = packet.safetyCarStatus
+            index.add_session(self.pkt_id, header.sessionTime, packet.safetyCarStatus)
+
+        elif header.packetId == 2 and self.num_laps is not None:
+            lap_data = LapDataPacket(data)
+            index.add_lap_data(self.pkt_id, lap_data)
+            self.race_position = self.get_live_race_position(lap_data)
+            if self.spin_detector is None and index.participants is not None:
+                self.spin_detector = SpinDetector(index.track_length, self.num_laps,
+                                                  [p.is_active for p in index.participants])
+            if self.spin_detector is not None:
+                self.spin_detector.add(self.race_position)
+
+        elif header.packetId == 3:
+            event = EventRecord(packet.eventStringCode, packet.eventDetails.fastestLap.vehicleIdx,
+                                packet.eventDetails.fastestLap.lapTime)
+            index.add_event(self.pkt_id, event)
+            code = event.code.decode()
+            if code == "FTLP":
+                race_duration = self.get_current_race_duration() if self.race_position is not None else 0
+                self.fastest_lap_info = FastestLapInfo(race_duration, event.lap_time, event.vehicle_idx)
+            if code == "CHQF":
+                self.chequered_flag = True
+            if code == "SEND":
+                self.finished = True
+
+        elif header.packetId == 4 and index.participants is None:
+            index.participants = SessionIndex.load_participants(TelemetryCache.decode_participants(data))
+
+        elif header.packetId == 8 and index.final_classification is None:
+            index.final_classification = [FinalClassification(*record)
+                                          for record in TelemetryCache.decode_final_classification(data)]
+
+        if index.participants is not None and self.race_position is not None:
+            self.ready.set()
+
+    def get_live_race_position(self, lap_data):
+        self.laps = [lap for lap in self.index.lap_infos if not lap.is_formation_lap()]
+        leader = get_top_running_car(lap_data, self.num_laps)
+        leader_lap = lap_data.lap_number[leader]
+        if 0 < leader_lap <= len(self.laps) and self.laps[leader_lap - 1].driver_start_times[leader] is not None:
+            return self.get_race_position(lap_data)
+
+        # Until the race starts, or the leader's lap is seen from its start, the race time is not known
+        race_duration = self.get_current_race_duration() if self.race_position is not None else 0
+        return [CarInfo(race_duration, lap_data.position[i], lap_data.lap_number[i], lap_data.lap_distance[i],
+                        lap_data.total_distance[i], lap_data.pit_status[i], lap_data.result_status[i],
+                        lap_data.penalties[i])
+                for i in range(len(lap_data.lap_number))]
+
+
+class TelemetryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, live_session):
+        self.live_session = live_session
+
+    def datagram_received(self, data, addr):
+        self.live_session.add_packet(data)
+
+
+class LiveState:
+    # Same interface as GameState for the renderer, showing the latest race position of a LiveSession.  Lap times
+    # are only known once the laps are over, so cars are placed by the distance they covered instead.
+    def __init__(self, session):
+        self.session = session
+        self.num_laps = session.get_number_of_laps()
+        self.track_length = session.get_track_length()
+        self.final_classification = session.get_final_classification()
+        self.participants = session.get_participants_info()
+        self.car_states = [state.CarState(i, self) for (i, car) in enumerate(self.participants)]
+        self.cars = None
+        self.session_progress = 0
+        self.player_timestamp = 0
+        self.start_time = time.monotonic()
+        self.end_time = None
+
+        # There is no going back in a live race, the renderer only keeps its initial state
+        self.frame = 0
+        self.keyframe_interval = sys.maxsize
+        self.keyframes = {0}
+        self.load_session()
+
+    def car_state(self, index):
+        return self.car_states[index]
+
+    def is_safety_car(self):
+        return not self.session.safety_car_status == 0
+
+    def fastest_lap(self):
+        return self.session.fastest_lap_info
+
+    def chequered_flag(self):
+        return self.session.chequered_flag
+
+    def next_frame(self):
+        if self.session.finished:
+            if self.end_time is None:
+                self.end_time = time.monotonic()
+            elif time.monotonic() - self.end_time > POST_RACE_SECONDS:
+                return False
+        self.frame += 1
+        self.load_session()
+        return True
+
+    def update_classification(self):
+        # The classification arrives once the race is over.  Returns True when it just did.
+        if self.final_classification is not None:
+            return False
+        self.final_classification = self.session.get_final_classification()
+        return self.final_classification is not None
+
+    def load_session(self):
+        self.player_timestamp = time.monotonic() - self.start_time
+        self.cars = self.session.get_current_race_position()
+        started = len(self.session.laps) > 0
+        spin_detector = self.session.spin_detector
+        for i, (car_state, car) in enumerate(zip(self.car_states, self.cars)):
+            progress = car.lap_number - 1 + car.lap_distance / self.track_length if started else 0
+            car_state.progress = min(max(progress, 0), self.num_laps)
+            # Finished
+            car_state.finished = car.result_status == 3
+            car_state.is_spinning = spin_detector is not None and spin_detector.is_spinning_now(i) \
+                and not self.is_safety_car()
+        self.session_progress = max(car_state.progress for car_state in self.car_states) / self.num_laps
+
+
+async def show_race(game_state, renderers, video_outs, fps, headless):
+    # Draws the latest race position every frame.  Packets are received while waiting for the next frame, and
+    # read right before drawing it, so the picture is never more than a frame behind the game.
+    loop = asyncio.get_running_loop()
+    next_frame_time = loop.time()
+    while True:
+        if not headless:
+            for event in pygame.event.get():
+                if event.type == pygame.locals.QUIT:
+                    return
+                if event.type == pygame.locals.VIDEOEXPOSE:
+                    pygame.display.update()
+
+        if game_state.update_classification():
+            for renderer in renderers:
+                renderer.prepare_classification_surfaces()
+                renderer.right_side_space = renderer.extra_right_space()
+
+        if video_outs:
+            changed_rects = video.export_frames(renderers, video_outs)[0]
+        else:
+            changed_rects = renderers[0].update_changes()
+        if not headless:
+            pygame.display.update(changed_rects)
+
+        # Frames that are late are dropped rather than caught up with
+        next_frame_time = max(next_frame_time + 1 / fps, loop.time())
+        await asyncio.sleep(next_frame_time - loop.time())
+        if not game_state.next_frame():
+            return
+
+
+async def run_live(args):
+    loop = asyncio.get_running_loop()
+    live_session = LiveSession(args.names)
+    transport, _ = await loop.create_datagram_endpoint(lambda: TelemetryProtocol(live_session),
+                                                       local_addr=(args.host, args.port))
+    video_outs = []
+    try:
+        print(f"Waiting for a race on port {args.port}")
+        await live_session.ready.wait()
+        game_state = LiveState(live_session)
+        headless = args.headless or args.backend == "numpy"
+        renderers = [render.Renderer("Race Viewer", game_state, headless, args.backend,
+                                     render.Layout(args.width, args.height))]
+        if args.output is not None:
+            encoder = video.EncoderSettings(args.encoder)
+            video_outs.append(video.VideoWriter(args.output, args.width, args.height, args.fps, encoder))
+        await show_race(game_state, renderers, video_outs, args.fps, headless)
+    finally:
+        transport.close()
+        for video_out in video_outs:
+            video_out.close()
+        pygame.quit()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Show an F1 2020 race live, from the game's UDP telemetry.")
+    parser.add_argument("--host", default="0.0.0.0", help="address to listen on (default: 0.0.0.0)")
+    parser.add_argument("--port", type=int, default=TELEMETRY_PORT,
+                        help=f"port the game sends telemetry to (default: {TELEMETRY_PORT})")
+    parser.add_argument("--names", default=None, help="file with one driver name per line")
+    parser.add_argument("--output", default=None, help="also record what is shown to this video file")
+    parser.add_argument("--encoder", choices=video.EncoderSettings.NAMES, default="opencv",
+                        help="encoder for --output (default: opencv)")
+    parser.add_argument("--width", type=int, default=WINDOW_WIDTH, help=f"window width (default: {WINDOW_WIDTH})")
+    parser.add_argument("--height", type=int, default=WINDOW_HEIGHT,
+                        help=f"window height (default: {WINDOW_HEIGHT})")
+    parser.add_argument("--fps", type=int, default=FPS, help=f"frames per second (default: {FPS})")
+    parser.add_argument("--headless", action="store_true", help="render without a window")
+    parser.add_argument("--backend", choices=render.BACKENDS, default="pygame",
+                        help="numpy draws straight into the video frames without SDL, implies --headless "
+                             "(default: pygame)")
+    return parser.parse_args()
+
+
+def run():
+    asyncio.run(run_live(parse_args()))
+
+
+if __name__ == "__main__":
+    run()
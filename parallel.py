@@ -0,0 +1,101 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import pygame
+
+import render
+import state
+import video
+from session import Session
+from timeline import Timeline, TimelineState
+
+
+class RenderJob:
+    def __init__(self, session_file, names_file, width, height, fps, seconds_per_lap, start_frame,
+                 timeline_file=None, encoder=None, backend="pygame", extra_sizes=None):
+        self.session_file = session_file
+        self.names_file = names_file
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.seconds_per_lap = seconds_per_lap
+        self.start_frame = start_frame
+        self.timeline_file = timeline_file
+        self.encoder = encoder if encoder is not None else video.EncoderSettings()
+        self.backend = backend
+        # Every size is rendered to its own output, from the same game state
+        self.extra_sizes = extra_sizes if extra_sizes is not None else []
+
+    def sizes(self):
+        return [(self.width, self.height)] + self.extra_sizes
+
+    def create_state(self):
+        session = Session(self.session_file, self.names_file)
+        if self.timeline_file is not None:
+            timeline = Timeline.open(self.timeline_file, session, self.fps, self.seconds_per_lap, self.start_frame)
+            return TimelineState(session, timeline)
+        return state.GameState(session, self.fps, self.seconds_per_lap, self.start_frame)
+
+
+def render_segment(job, first_frame, end_frame, outputs):
+    # Renders video frames [first_frame, end_frame) to outputs, one for each of the job's sizes, end_frame None meaning
+    # until the race is over.  Every worker replays the race from the start, or reads it from the timeline, so the
+    # animations that are in progress at first_frame look exactly like in a serial render.
+    game_state = job.create_state()
+    renderers = [render.Renderer("Race Viewer", game_state, headless=True, backend=job.backend,
+                                 layout=render.Layout(width, height)) for width, height in job.sizes()]
+
+    frames_written = 0
+    try:
+        running = render.seek_renderers(renderers, first_frame)
+        if running:
+            video_outs = [video.VideoWriter(output, width, height, job.fps, job.encoder, first_frame)
+                          for output, (width, height) in zip(outputs, job.sizes())]
+            while running and (end_frame is None or game_state.frame < end_frame):
+                video.export_frames(renderers, video_outs)
+                frames_written += 1
+                running = game_state.next_frame()
+            for video_out in video_outs:
+                video_out.close()
+    finally:
+        # SDL turns SIGTERM into a quit event while it is initialized, which would keep the pool from stopping
+        # the worker, also after a failed segment
+        pygame.quit()
+    return frames_written
+
+
+def render_parallel(job, outputs, processes, first_frame=0, end_frame=None):
+    # Renders frames [first_frame, end_frame) split between the processes.  Without an end frame, the exact number
+    # of frames is only known once the recording runs out, so the last segment is open ended.
+    last_frame = end_frame if end_frame is not None else job.create_state().estimated_frame_count()
+    boundaries = [first_frame + max(last_frame - first_frame, 0) * i // processes for i in range(processes)] \
+        + [end_frame]
+
+    if not job.encoder.writes_video_file():
+        # Image files are numbered by frame, every worker can write to the outputs directly
+        render_segments(job, boundaries, [outputs] * processes)
+        return
+
+    segment_dir = tempfile.mkdtemp(prefix=".segments-", dir=os.path.dirname(os.path.abspath(outputs[0])))
+    segments = [[os.path.join(segment_dir, f"segment{i:03d}-{j}{os.path.splitext(output)[1]}")
+                 for j, output in enumerate(outputs)] for i in range(processes)]
+    try:
+        frames_written = render_segments(job, boundaries, segments)
+        for j, output in enumerate(outputs):
+            video.concatenate([segment[j] for segment, frames in zip(segments, frames_written) if frames > 0], output)
+    finally:
+        shutil.rmtree(segment_dir, ignore_errors=True)
+
+
+def render_segments(job, boundaries, outputs):
+    # SDL state must not be shared with the workers, so they are spawned rather than forked
+    context = multiprocessing.get_context("spawn")
+    # Leaving the block terminates the workers that are still running when a segment failed
+    with context.Pool(len(outputs)) as pool:
+        frames_written = pool.starmap(render_segment, [(job, boundaries[i], boundaries[i + 1], outputs[i])
+                                                       for i in range(len(outputs))])
+        pool.close()
+        pool.join()
+    return frames_written
@@ -1,3 +1,220 @@
-import f1_2020_telemetry.cli.recorder as recorder
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import ctypes
+import os
+import socket
+import sqlite3
+import sys
+import time
 
-recorder.main()
\ No newline at end of file
+from f1_2020_telemetry import packets
+
+from replay import TELEMETRY_PORT
+
+# Session, lap data, event, participants and final classification packets, the only ones the viewer reads
+VIEWER_PACKETS = [1, 2, 3, 4, 8]
+# Received packets are written in one transaction this often, or as soon as this many are waiting
+WRITE_INTERVAL = 1.0
+WRITE_BATCH_SIZE = 10000
+# Room for the packets received while the process is busy, the system may give less
+RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Same table as the recordings of the telemetry library, with an index to read some packet types only
+CREATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS packets (
+        pkt_id            INTEGER  PRIMARY KEY,
+        timestamp         REAL     NOT NULL,
+        packetFormat      INTEGER  NOT NULL,
+        gameMajorVersion  INTEGER  NOT NULL,
+        gameMinorVersion  INTEGER  NOT NULL,
+        packetVersion     INTEGER  NOT NULL,
+        packetId          INTEGER  NOT NULL,
+        sessionUID        CHAR(16) NOT NULL,
+        sessionTime       REAL     NOT NULL,
+        frameIdentifier   INTEGER  NOT NULL,
+        playerCarIndex    INTEGER  NOT NULL,
+        packet            BLOB     NOT NULL
+    );
+"""
+CREATE_INDEX = "CREATE INDEX IF NOT EXISTS packets_packet_id ON packets (packetId, pkt_id);"
+COLUMNS = "pkt_id, timestamp, packetFormat, gameMajorVersion, gameMinorVersion, packetVersion, packetId, " \
+          "sessionUID, sessionTime, frameIdentifier, playerCarIndex, packet"
+INSERT = f"INSERT INTO packets ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"
+
+
+class PacketFilter:
+    # Keeps the packet types asked for, None meaning all of them, and only every n-th packet of the decimated ones
+    def __init__(self, packet_ids=VIEWER_PACKETS, decimation=None):
+        self.packet_ids = None if packet_ids is None else set(packet_ids)
+        self.decimation = dict(decimation) if decimation is not None else {}
+        self.counts = collections.Counter()
+
+    def keep(self, packet_id):
+        if self.packet_ids is not None and packet_id not in self.packet_ids:
+            return False
+        count = self.counts[packet_id]
+        self.counts[packet_id] = count + 1
+        return count % self.decimation.get(packet_id, 1) == 0
+
+
+class PacketWriter:
+    # Writes rows of the packets table in large transactions.  The file is in WAL mode while it is written, so the
+    # viewer can read it at the same time, and is left in the default mode for read-only access once closed.
+    def __init__(self, filename):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute("PRAGMA synchronous=NORMAL;")
+        self.conn.execute(CREATE_TABLE)
+        self.conn.execute(CREATE_INDEX)
+        self.conn.commit()
+
+    def write(self, rows):
+        with self.conn:
+            self.conn.executemany(INSERT, rows)
+
+    def close(self):
+        self.conn.execute("PRAGMA journal_mode=DELETE;")
+        self.conn.close()
+
+
+class Recorder:
+    # Records the packets of every session to its own file.  Files are written by another thread, so that
+    # receiving packets never waits for the disk.
+    def __init__(self, packet_filter, directory="."):
+        self.packet_filter = packet_filter
+        self.directory = directory
+        # Rows of the current session that were not handed to the writer thread yet
+        self.session_uid = None
+        self.rows = []
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        # Only used from the writer thread
+        self.writer = None
+        self.writer_session_uid = None
+        # First error of the writer thread, recording stops with it
+        self.error = None
+
+    def add_packet(self, timestamp, data):
+        if self.error is not None:
+            return
+        if len(data) < ctypes.sizeof(packets.PacketHeader):
+            return
+        header = packets.PacketHeader.from_buffer_copy(data)
+        packet_type = packets.HeaderFieldsToPacketType.get((header.packetFormat, header.packetVersion,
+                                                            header.packetId))
+        if packet_type is None or len(data) != ctypes.sizeof(packet_type):
+            return
+        if not self.packet_filter.keep(header.packetId):
+            return
+
+        # Session UIDs are stored as hex strings, since SQLite integers are signed
+        session_uid = f"{header.sessionUID:016x}"
+        if session_uid != self.session_uid:
+            self.flush()
+            self.session_uid = session_uid
+        self.rows.append((None, timestamp, header.packetFormat, header.gameMajorVersion, header.gameMinorVersion,
+                          header.packetVersion, header.packetId, session_uid, header.sessionTime,
+                          header.frameIdentifier, header.playerCarIndex, data))
+        if len(self.rows) >= WRITE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows) > 0:
+            self.executor.submit(self.write, self.session_uid, self.rows).add_done_callback(self.write_done)
+            self.rows = []
+
+    def write_done(self, future):
+        if future.exception() is not None and self.error is None:
+            self.error = future.exception()
+
+    def check(self):
+        # Raises the error that stopped the writer thread, if any
+        if self.error is not None:
+            raise self.error
+
+    def write(self, session_uid, rows):
+        if session_uid != self.writer_session_uid:
+            self.close_writer()
+            filename = os.path.join(self.directory, f"F1_2020_{session_uid}.sqlite3")
+            try:
+                self.writer = PacketWriter(filename)
+            except sqlite3.Error as e:
+                raise sqlite3.OperationalError(f"{e}: {filename}") from e
+            self.writer_session_uid = session_uid
+            print(f"Recording to {filename}")
+        self.writer.write(rows)
+
+    def close_writer(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.writer_session_uid = None
+
+    def close(self):
+        if self.error is None:
+            self.flush()
+        self.executor.submit(self.close_writer).add_done_callback(self.write_done)
+        self.executor.shutdown()
+        self.check()
+
+
+class RecorderProtocol(asyncio.DatagramProtocol):
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    def datagram_received(self, data, addr):
+        self.recorder.add_packet(time.time(), data)
+
+
+async def record(recorder, host="0.0.0.0", port=TELEMETRY_PORT):
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(lambda: RecorderProtocol(recorder), local_addr=(host, port))
+    transport.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+    print(f"Recording packets from port {port}, press Ctrl-C to stop")
+    try:
+        while True:
+            await asyncio.sleep(WRITE_INTERVAL)
+            recorder.flush()
+            recorder.check()
+    finally:
+        transport.close()
+        recorder.close()
+
+
+def add_filter_args(parser):
+    parser.add_argument("--packets", type=int, nargs="+", default=VIEWER_PACKETS, metavar="PACKET_ID",
+                        help="packet types to keep (default: the ones the viewer reads, "
+                             f"{' '.join(str(packet_id) for packet_id in VIEWER_PACKETS)})")
+    parser.add_argument("--all-packets", action="store_true", help="keep every packet type")
+    parser.add_argument("--decimate", type=int, nargs=2, action="append", default=[], metavar=("PACKET_ID", "N"),
+                        help="only keep every N-th packet of a type (can be repeated)")
+
+
+def packet_filter(args):
+    return PacketFilter(None if args.all_packets else args.packets, args.decimate)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Record F1 2020 telemetry to SQLite3 files, one for each session.")
+    parser.add_argument("--host", default="0.0.0.0", help="address to listen on (default: 0.0.0.0)")
+    parser.add_argument("--port", type=int, default=TELEMETRY_PORT,
+                        help=f"port the game sends telemetry to (default: {TELEMETRY_PORT})")
+    parser.add_argument("--directory", default=".", help="directory for the recordings (default: .)")
+    add_filter_args(parser)
+    return parser.parse_args()
+
+
+def run():
+    args = parse_args()
+    try:
+        asyncio.run(record(Recorder(packet_filter(args), args.directory), args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    except (OSError, sqlite3.Error) as e:
+        sys.exit(f"Recording stopped: {e}")
+
+
+if __name__ == "__main__":
+    run()
@@ -1,4 +1,6 @@
+import os
 import pygame.locals
+import canvas
 import text
 import math
 import datetime
@@ -8,43 +10,52 @@ WINDOW_WIDTH = 1940
 FPS = 60
 SECONDS_PER_LAP = 2
 START_FRAME = 0
+# pygame draws onto SDL surfaces, numpy draws straight into the BGR frames written to the video
+BACKENDS = ["pygame", "numpy"]
 
 # WINDOW_HEIGHT=480
 # WINDOW_WIDTH=720
 # START_FRAME = 24 * FPS * SECONDS_PER_LAP
 
-SCALE_FACTOR= WINDOW_HEIGHT / 1080
-
 CAR_FONT_SIZE_BASE=26
 INFO_FONT_SIZE_BASE=100
 TRACK_FONT_SIZE_BASE=60
 
 TEXT_BOX_BORDER_BASE=5
 
+CAR_SPACING = 0.5
+
+LAPS_PER_SCREEN = 3
 
-CAR_FONT_SIZE=int(CAR_FONT_SIZE_BASE * SCALE_FACTOR)
-INFO_FONT_SIZE=int(INFO_FONT_SIZE_BASE * SCALE_FACTOR)
-TRACK_FONT_SIZE=int(TRACK_FONT_SIZE_BASE * SCALE_FACTOR)
 
-TEXT_BOX_BORDER=int(TEXT_BOX_BORDER_BASE * SCALE_FACTOR)
+class Layout:
+    # Sizes and positions of everything on screen, which all depend on the window size
+    def __init__(self, width=WINDOW_WIDTH, height=WINDOW_HEIGHT):
+        self.window_width = width
+        self.window_height = height
 
-TOP_BORDER = WINDOW_HEIGHT / 10
-BOTTOM_BORDER = WINDOW_HEIGHT / 20
-LEFT_BORDER = WINDOW_WIDTH / 20
-RIGHT_BORDER = WINDOW_WIDTH / 20
+        self.scale_factor = self.window_height / 1080
 
-CAR_SPACING = 0.5
+        self.car_font_size = int(CAR_FONT_SIZE_BASE * self.scale_factor)
+        self.info_font_size = int(INFO_FONT_SIZE_BASE * self.scale_factor)
+        self.track_font_size = int(TRACK_FONT_SIZE_BASE * self.scale_factor)
 
-TRACK_HEIGHT = WINDOW_HEIGHT - TOP_BORDER - BOTTOM_BORDER
-VISIBLE_TRACK_WIDTH = WINDOW_WIDTH - LEFT_BORDER - RIGHT_BORDER
+        self.text_box_border = int(TEXT_BOX_BORDER_BASE * self.scale_factor)
 
-CAR_WIDTH = (WINDOW_HEIGHT - TOP_BORDER - BOTTOM_BORDER) / (20 + 19 * CAR_SPACING)
-CAR_LENGTH = CAR_WIDTH * 2
+        self.top_border = self.window_height / 10
+        self.bottom_border = self.window_height / 20
+        self.left_border = self.window_width / 20
+        self.right_border = self.window_width / 20
 
-VIEWPORT_INITIAL_X = -LEFT_BORDER - CAR_LENGTH
+        self.track_height = self.window_height - self.top_border - self.bottom_border
+        self.visible_track_width = self.window_width - self.left_border - self.right_border
 
-LAPS_PER_SCREEN = 3
-LAP_WIDTH = VISIBLE_TRACK_WIDTH / LAPS_PER_SCREEN
+        self.car_width = (self.window_height - self.top_border - self.bottom_border) / (20 + 19 * CAR_SPACING)
+        self.car_length = self.car_width * 2
+
+        self.viewport_initial_x = -self.left_border - self.car_length
+
+        self.lap_width = self.visible_track_width / LAPS_PER_SCREEN
 
 POSITION_CHANGE_DURATION = 0.5
 
@@ -54,6 +65,75 @@ YELLOW=(255, 255, 0)
 FL_PURPLE=(202, 155, 247)
 
 SPIN_ANIMATION_DURATION = 0.5
+SPIN_ROTATION_STEPS = 64
+
+
+class CarSprites:
+    # Car bodies drawn once for each team colour and spin rotation, the rotation rounded to rotation_steps per turn.
+    # Sprites come with the offset to blit them at from the top left corner of the upright car.
+    def __init__(self, layout, rotation_steps=SPIN_ROTATION_STEPS):
+        self.layout = layout
+        self.rotation_steps = rotation_steps
+        self.bodies = {}
+
+    def body(self, color, rotation):
+        step = round(rotation * self.rotation_steps) % self.rotation_steps
+        key = (color, step)
+        if key not in self.bodies:
+            self.bodies[key] = self.draw_body(color, step / self.rotation_steps)
+        return self.bodies[key]
+
+    def draw_body(self, color, rotation):
+        rect = pygame.Rect(0, 0, self.layout.car_length, self.layout.car_width)
+        points = (rect.topleft, rect.topright, rect.bottomright, rect.bottomleft)
+        if rotation:
+            points = self.rotate_around_center(points, rotation, rect)
+        left = math.floor(min(x for x, y in points))
+        top = math.floor(min(y for x, y in points))
+        width = math.ceil(max(x for x, y in points)) - left + 1
+        height = math.ceil(max(y for x, y in points)) - top + 1
+        sprite = pygame.Surface((width, height), pygame.SRCALPHA)
+        pygame.draw.polygon(sprite, color, self.translate(points, (-left, -top)), 0)
+        return sprite, (left, top)
+
+    def plate(self, body, name_surface):
+        # The body with the driver name next to it, as Car.draw places them
+        sprite, (left, top) = body
+        rect = pygame.Rect(0, 0, self.layout.car_length, self.layout.car_width)
+        body_rect = sprite.get_rect(topleft=(left, top))
+        name_rect = name_surface.get_rect()
+        name_rect.centery = rect.centery
+        name_rect.left = rect.right + 5
+        plate_rect = body_rect.union(name_rect)
+        plate = pygame.Surface(plate_rect.size, pygame.SRCALPHA)
+        plate.blit(sprite, body_rect.move(-plate_rect.left, -plate_rect.top))
+        plate.blit(name_surface, name_rect.move(-plate_rect.left, -plate_rect.top))
+        return plate, plate_rect.topleft
+
+    def rotate_around_center(self, points, rotation_amount, rect):
+        translation = (-rect.centerx, -rect.centery)
+        points = self.translate(points, translation)
+
+        points = self.rotate(points, rotation_amount)
+
+        translation = (rect.centerx, rect.centery)
+        return self.translate(points, translation)
+
+    def translate(self, points, translation):
+        result = []
+        for point in points:
+            result.append((point[0] + translation[0], point[1] + translation[1]))
+        return result
+
+    def rotate(self, points, rotation_amount):
+        result = []
+        angle = rotation_amount * 2 * math.pi
+        for point in points:
+            x = math.cos(angle) * point[0] - math.sin(angle) * point[1]
+            y = math.sin(angle) * point[0] + math.cos(angle) * point[1]
+            result.append((x, y))
+        return result
+
 
 class Car:
     def __init__(self, car_index, renderer):
@@ -61,7 +141,7 @@ class Car:
         self.renderer = renderer
 
         self.color = self.get_color(self.car_state().team_id())
-        self.rect = pygame.Rect(0, 0, CAR_LENGTH, CAR_WIDTH)
+        self.rect = pygame.Rect(0, 0, renderer.layout.car_length, renderer.layout.car_width)
 
         self.name = self.car_state().driver_name()
         self.position_queue = [0]
@@ -79,19 +159,33 @@ class Car:
     def car_state(self):
         return self.renderer.state.car_state(self.car_index)
 
+    def save_state(self):
+        return list(self.position_queue), self.last_position_change, self.penalties, self.penalties_img, \
+            self.spin_start_timestamp, self.spin_end_timestamp, self.rotation
+
+    def restore_state(self, saved):
+        position_queue, self.last_position_change, self.penalties, self.penalties_img, \
+            self.spin_start_timestamp, self.spin_end_timestamp, self.rotation = saved
+        self.position_queue = list(position_queue)
+
     def get_base_name_width(self):
         return text.prepare_text(self.name, self.renderer.driver_font, BLACK).get_rect().width
 
     def prepare_name_surfaces(self, width):
-        self.name_surface = text.prepare_text(self.name, self.renderer.driver_font, WHITE, BLACK, width, CAR_WIDTH, TEXT_BOX_BORDER)
-        self.fl_name_surface = text.prepare_text(self.name, self.renderer.driver_font, WHITE, FL_PURPLE, width, CAR_WIDTH, TEXT_BOX_BORDER)
+        layout = self.renderer.layout
+        self.name_surface = text.prepare_text(self.name, self.renderer.driver_font, WHITE, BLACK, width, layout.car_width, layout.text_box_border)
+        self.fl_name_surface = text.prepare_text(self.name, self.renderer.driver_font, WHITE, FL_PURPLE, width, layout.car_width, layout.text_box_border)
+        # The upright car and its name plate, drawn with a single blit while the car is not spinning
+        body = self.renderer.car_sprites.body(self.color, 0)
+        self.plates = {False: self.renderer.car_sprites.plate(body, self.name_surface),
+                       True: self.renderer.car_sprites.plate(body, self.fl_name_surface)}
 
     def prepare_final_time_surface(self):
         final_time_string = self.get_final_time_string()
         self.classification_surface = \
             text.prepare_text(final_time_string,
                               self.renderer.driver_font,
-                              WHITE, None, None, CAR_WIDTH, TEXT_BOX_BORDER)
+                              WHITE, None, None, self.renderer.layout.car_width, self.renderer.layout.text_box_border)
 
     def is_active(self):
         return self.car_state().is_active()
@@ -150,7 +244,7 @@ class Car:
             self.penalties = car.penalties
             if self.penalties > 0:
                 penalties_msg = f"[+{self.penalties}]"
-                self.penalties_img = self.renderer.driver_font.render(penalties_msg, True, (255, 255, 255))
+                self.penalties_img = text.prepare_text(penalties_msg, self.renderer.driver_font, WHITE)
             else:
                 self.penalties_img = None
 
@@ -191,50 +285,20 @@ class Car:
         result = float(self.position_queue[1]) - float((self.position_queue[1] - self.position_queue[0])) * (1.0 - position_change_progress)
         return result
 
-    def get_polygon(self):
-        points = (self.rect.topleft, self.rect.topright, self.rect.bottomright, self.rect.bottomleft)
-        if self.spin_start_timestamp:
-            points = self.rotate_around_center(points, self.rotation, self.rect)
-        return points
-
-    def rotate_around_center(self, points, rotation_amount, rect):
-        translation = (-rect.centerx, -rect.centery)
-        points = self.translate(points, translation)
-
-        points = self.rotate(points, rotation_amount)
-
-        translation = (rect.centerx, rect.centery)
-        return self.translate(points, translation)
-
-    def translate(self, points, translation):
-        result = []
-        for point in points:
-            result.append((point[0] + translation[0], point[1] + translation[1]))
-        return result
-
-    def rotate(self, points, rotation_amount):
-        result = []
-        angle = rotation_amount * 2 * math.pi
-        for point in points:
-            x = math.cos(angle) * point[0] - math.sin(angle) * point[1]
-            y = math.sin(angle) * point[0] + math.cos(angle) * point[1]
-            result.append((x, y))
-        return result
-
-    def draw(self, surface, viewport_position, player_timestamp):
+    def sprites(self, viewport_position, player_timestamp):
+        # Images to draw for the car and the positions to draw them at, in drawing order
         car_state = self.car_state()
         progress = car_state.progress
         position = self.get_position_for_rendering(player_timestamp)
+        sprites = []
 
-        # Draw the car
-        self.rect.top = TOP_BORDER + (position - 1) * CAR_WIDTH * (1 + CAR_SPACING)
-        self.rect.right = progress * LAP_WIDTH - viewport_position
-        polygon = self.get_polygon()
-        pygame.draw.polygon(surface, self.color, polygon, 0)
-
-        # Draw the driver name
+        # Draw the car and the driver name
+        layout = self.renderer.layout
+        self.rect.top = layout.top_border + (position - 1) * layout.car_width * (1 + CAR_SPACING)
+        self.rect.right = progress * layout.lap_width - viewport_position
         fl = self.renderer.state.fastest_lap()
-        if fl is not None and fl.driver_idx == self.car_index:
+        fastest_lap = fl is not None and fl.driver_idx == self.car_index
+        if fastest_lap:
             img_to_render = self.fl_name_surface
         else:
             img_to_render = self.name_surface
@@ -242,30 +306,40 @@ class Car:
         name_rect = img_to_render.get_rect()
         name_rect.centery = self.rect.centery
         name_rect.left = self.rect.right + 5
-        surface.blit(img_to_render, name_rect)
+        if self.spin_start_timestamp:
+            body, offset = self.renderer.car_sprites.body(self.color, self.rotation)
+            sprites.append((body, (self.rect.left + offset[0], self.rect.top + offset[1])))
+            sprites.append((img_to_render, name_rect.topleft))
+        else:
+            plate, offset = self.plates[fastest_lap]
+            sprites.append((plate, (self.rect.left + offset[0], self.rect.top + offset[1])))
 
         # Draw the pit flag
         if car_state.pit_status() != 0:
             pit_img_rect = self.renderer.pit_img.get_rect()
             pit_img_rect.centery = self.rect.centery
             pit_img_rect.left = name_rect.right + 5
-            surface.blit(self.renderer.pit_img, pit_img_rect)
+            sprites.append((self.renderer.pit_img, pit_img_rect.topleft))
 
         # Draw the penalties amount
         if self.penalties_img is not None:
             penalties_img_rect  = self.penalties_img.get_rect()
             penalties_img_rect.centery = self.rect.centery
             penalties_img_rect.right = self.rect.left - 5
-            surface.blit(self.penalties_img, penalties_img_rect)
+            sprites.append((self.penalties_img, penalties_img_rect.topleft))
 
         # Draw the final race time
         if car_state.finished:
             classification_img_rect = self.classification_surface.get_rect()
             classification_img_rect.centery = self.rect.centery
             classification_img_rect.left = name_rect.right + 5
-            surface.blit(self.classification_surface, classification_img_rect)
+            sprites.append((self.classification_surface, classification_img_rect.topleft))
+        return sprites
 
     def get_final_time_string(self):
+        if self.renderer.state.final_classification is None:
+            # Live races only get their classification once they are over
+            return ""
         final_classification = self.car_state().final_classification()
         leader_classification = self.car_state().leader_final_classification()
         if final_classification.position == 1:
@@ -291,17 +365,35 @@ class Car:
 
 
 class Renderer:
-    def __init__(self, caption, state):
-        pygame.init()
+    def __init__(self, caption, state, headless=False, backend="pygame", layout=None):
+        self.layout = layout if layout is not None else Layout()
+        if backend == "numpy":
+            # Only fonts are needed from pygame, frames are always offscreen
+            pygame.font.init()
+        else:
+            if headless:
+                # No window at all, frames are only rendered to an offscreen surface
+                os.environ["SDL_VIDEODRIVER"] = "dummy"
+            pygame.init()
         self.initialize_fonts()
 
         self.state = state
         self.cars = []
+        self.car_sprites = CarSprites(self.layout)
 
-        self.display_surface = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
-        pygame.display.set_caption(caption)
+        size = (self.layout.window_width, self.layout.window_height)
+        if backend == "numpy":
+            self.display_surface = canvas.FrameCanvas(*size)
+        elif headless:
+            self.display_surface = pygame.Surface(size)
+        else:
+            self.display_surface = pygame.display.set_mode(size)
+            pygame.display.set_caption(caption)
 
         self.viewport_position = 0
+        # What draw_changes last left on the display surface
+        self.drawn_sprites = None
+        self.drawn_viewport_position = None
 
         self.initialize_cars()
 
@@ -311,12 +403,17 @@ class Renderer:
 
         self.prepare_pit_img()
 
+        self.prepare_track_tiles()
+
         self.right_side_space = self.extra_right_space()
 
+        # Car animation states at the game state keyframes, saved before advancing to the keyframe
+        self.keyframes = {self.state.frame: self.save_state()}
+
     def initialize_fonts(self):
-        self.driver_font = pygame.font.Font("font-bold.ttf", CAR_FONT_SIZE)
-        self.info_font = pygame.font.Font("font-bold.ttf", INFO_FONT_SIZE)
-        self.lap_font = pygame.font.Font("font-bold.ttf", TRACK_FONT_SIZE)
+        self.driver_font = pygame.font.Font("font-bold.ttf", self.layout.car_font_size)
+        self.info_font = pygame.font.Font("font-bold.ttf", self.layout.info_font_size)
+        self.lap_font = pygame.font.Font("font-bold.ttf", self.layout.track_font_size)
 
     def initialize_cars(self):
         for i in range(len(self.state.car_states)):
@@ -332,7 +429,16 @@ class Renderer:
             car.prepare_final_time_surface()
 
     def prepare_pit_img(self):
-        self.pit_img = text.prepare_text("PIT", self.driver_font, (0, 0, 0), (255, 255, 0), height=CAR_WIDTH, border=TEXT_BOX_BORDER)
+        self.pit_img = text.prepare_text("PIT", self.driver_font, (0, 0, 0), (255, 255, 0), height=self.layout.car_width, border=self.layout.text_box_border)
+
+    def prepare_track_tiles(self):
+        # The track background is the same for every lap, so it is drawn from two lap-sized tiles, one of them
+        # starting with the lap line, and the lap labels rendered once
+        self.track_tile = pygame.Surface((math.ceil(self.layout.lap_width) + 1, self.layout.window_height))
+        self.track_tile.fill((160, 160, 160))
+        self.lap_line_tile = self.track_tile.copy()
+        pygame.draw.line(self.lap_line_tile, (255, 255, 255), (1, 0), (1, self.layout.window_height), 4)
+        self.lap_text_imgs = [text.prepare_text(f"Lap {i+1}", self.lap_font, WHITE) for i in range(self.state.num_laps)]
 
     def max_name_width(self):
         return max([car.name_surface.get_rect().width for car in self.cars])
@@ -344,38 +450,123 @@ class Renderer:
         return self.max_name_width() + self.max_classification_width() + 20
 
     def update_viewport(self, session_progress):
-        initial_viewport_position = VIEWPORT_INITIAL_X
-        final_viewport_position = LAP_WIDTH * self.state.num_laps - WINDOW_WIDTH + max(RIGHT_BORDER, self.right_side_space)
+        layout = self.layout
+        initial_viewport_position = layout.viewport_initial_x
+        final_viewport_position = layout.lap_width * self.state.num_laps - layout.window_width + max(layout.right_border, self.right_side_space)
         return initial_viewport_position + session_progress * (final_viewport_position - initial_viewport_position)
 
     def update(self):
-        self.display_surface.fill((160, 160, 160))
+        self.advance()
+        self.draw()
+
+    def update_changes(self):
+        self.advance()
+        return self.draw_changes()
+
+    def advance(self):
+        # Moves the viewport and the car animations to the current frame without drawing anything.
+        # Skipped frames still need this to keep position change and spin animations in sync.
+        frame = self.state.frame
+        if frame % self.state.keyframe_interval == 0 and frame not in self.keyframes:
+            self.keyframes[frame] = self.save_state()
+
         progress = self.state.session_progress
         if progress > 1:
             progress = 1
         self.viewport_position = self.update_viewport(progress)
-        self.draw_track(self.display_surface)
 
         for car in self.cars:
             car.update(self.state.player_timestamp)
+
+    def seek(self, frame):
+        # Moves the game state and the car animations to the given frame, ready for update().  Returns False if
+        # the race ends before that.
+        return seek_renderers([self], frame)
+
+    def save_state(self):
+        return self.viewport_position, [car.save_state() for car in self.cars]
+
+    def restore_state(self, saved):
+        self.viewport_position, cars = saved
+        for car, car_saved in zip(self.cars, cars):
+            car.restore_state(car_saved)
+
+    def draw(self):
+        self.draw_track(self.display_surface)
+        self.drawn_sprites = self.sprites()
+        self.drawn_viewport_position = self.viewport_position
+        for img, position in self.drawn_sprites:
+            self.display_surface.blit(img, position)
+
+    def draw_changes(self):
+        # Redraws only where sprites were added, moved or removed since the last frame, and returns those rects for
+        # pygame.display.update.  Scrolling the track changes the whole window.
+        if self.drawn_sprites is None or self.viewport_position != self.drawn_viewport_position:
+            self.draw()
+            return [self.display_surface.get_rect()]
+
+        sprites = self.sprites()
+        drawn = set(self.drawn_sprites)
+        current = set(sprites)
+        changed = [sprite for sprite in self.drawn_sprites if sprite not in current] + \
+                  [sprite for sprite in sprites if sprite not in drawn]
+        self.drawn_sprites = sprites
+
+        dirty_rects = [pygame.Rect(position, img.get_size()) for img, position in changed]
+        sprite_rects = [pygame.Rect(position, img.get_size()) for img, position in sprites]
+        for rect in dirty_rects:
+            self.display_surface.set_clip(rect)
+            self.draw_track(self.display_surface)
+            for i in rect.collidelistall(sprite_rects):
+                self.display_surface.blit(*sprites[i])
+        self.display_surface.set_clip(None)
+        return dirty_rects
+
+    def sprites(self):
+        sprites = []
         sorted_cars = sorted(self.cars, key=lambda c: -c.get_current_position_for_z_order())
         for car in sorted_cars:
             if car.is_active():
-                car.draw(self.display_surface, self.viewport_position, self.state.player_timestamp)
+                sprites += car.sprites(self.viewport_position, self.state.player_timestamp)
 
         if self.state.is_safety_car():
             info_text = f"[SC]"
-            img = self.info_font.render(info_text, True, (255, 255, 0))
-            self.display_surface.blit(img, (5, 5))
+            img = text.prepare_text(info_text, self.info_font, YELLOW)
+            sprites.append((img, (5, 5)))
+        return sprites
 
     def draw_track(self, surface):
-        for i in range(0, self.state.num_laps + 1):
-            lap_x = i * LAP_WIDTH - self.viewport_position
-            if -LAP_WIDTH < lap_x < WINDOW_WIDTH + LAP_WIDTH:
-                pygame.draw.line(surface, (255, 255, 255), (lap_x, 0), (lap_x, WINDOW_HEIGHT), 4)
-                if i < self.state.num_laps:
-                    lap_text = f"Lap {i+1}"
-                    lap_text_img = self.lap_font.render(lap_text, True, (255, 255, 255))
-                    self.display_surface.blit(lap_text_img, (lap_x + 10, 5))
-
-
+        # Tiles are placed where the lap lines were drawn: a 4 pixel line covers one column to the left of its
+        # truncated x position, and is left out when that position is off the left edge
+        lap_width = self.layout.lap_width
+        window_width = self.layout.window_width
+        i = math.floor(self.viewport_position / lap_width) - 1
+        while True:
+            lap_x = i * lap_width - self.viewport_position
+            line_x = int(lap_x)
+            if line_x - 1 >= window_width:
+                break
+            if 0 <= i <= self.state.num_laps and line_x >= 0:
+                surface.blit(self.lap_line_tile, (line_x - 1, 0))
+            else:
+                surface.blit(self.track_tile, (line_x - 1, 0))
+            if 0 <= i < self.state.num_laps and -lap_width < lap_x < window_width + lap_width:
+                surface.blit(self.lap_text_imgs[i], (lap_x + 10, 5))
+            i += 1
+
+
+def seek_renderers(renderers, frame):
+    # Renderer.seek for renderers that share their game state, every one of them with its own car animations
+    state = renderers[0].state
+    keyframe = max(k for k in renderers[0].keyframes
+                   if k <= frame and k in state.keyframes and all(k in r.keyframes for r in renderers))
+    if not keyframe <= state.frame <= frame:
+        state.restore_keyframe(keyframe)
+        for renderer in renderers:
+            renderer.restore_state(renderer.keyframes[keyframe])
+    while state.frame < frame:
+        for renderer in renderers:
+            renderer.advance()
+        if not state.next_frame():
+            return False
+    return True
@@ -0,0 +1,53 @@
+import argparse
+import asyncio
+
+from telemetry_cache import connect_read_only
+
+# The game's default telemetry port
+TELEMETRY_PORT = 20777
+# When sending falls behind by more than this, the rest of the packets are sent later instead of all at once,
+# which would overflow the receiver's socket buffer
+MAX_LATENESS = 0.1
+
+
+async def replay(filename, host="127.0.0.1", port=TELEMETRY_PORT, speed=1.0):
+    # Sends the recorded packets to host:port the way the game sent them, with their original spacing divided
+    # by speed
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=(host, port))
+    conn = connect_read_only(filename)
+    try:
+        start_time = loop.time()
+        first_timestamp = None
+        for timestamp, packet in conn.execute("SELECT timestamp, packet FROM packets ORDER BY pkt_id;"):
+            if first_timestamp is None:
+                first_timestamp = timestamp
+            delay = start_time + (timestamp - first_timestamp) / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif delay < -MAX_LATENESS:
+                start_time -= delay
+            transport.sendto(packet)
+    finally:
+        conn.close()
+        transport.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Send an F1 2020 race recording over UDP, like the game does.")
+    parser.add_argument("session", help="SQLite3 file recorded from the game's telemetry")
+    parser.add_argument("--host", default="127.0.0.1", help="destination address (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=TELEMETRY_PORT,
+                        help=f"destination port (default: {TELEMETRY_PORT})")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="how many times faster than the game to send the packets (default: 1)")
+    return parser.parse_args()
+
+
+def run():
+    args = parse_args()
+    asyncio.run(replay(args.session, args.host, args.port, args.speed))
+
+
+if __name__ == "__main__":
+    run()
@@ -1,6 +1,8 @@
-import sqlite3
-import f1_2020_telemetry.packets as packets
+import copy
+
+import numpy as np
 from driver_names import driver_names
+from telemetry_cache import EventRecord, TelemetryCache, connect_read_only
 
 class FinalClassification:
     def __init__(self, position, num_laps, total_race_time, penalties_time):
@@ -44,6 +46,29 @@ class CarInfo:
         return str(vars(self))
 
 
+class RaceReplay:
+    # Race positions for every replayed packet, as (packets x cars) matrices.  Packets that are not lap data
+    # repeat the race position of the most recent lap data packet, just like read_next_packet does.  The
+    # safety car and fastest lap arrays hold the session state after reading each packet.
+    def __init__(self, timestamp, lap_number, lap_distance, total_distance, pit_status, position, result_status,
+                 penalties, safety_car_status, fastest_lap_driver, fastest_lap_timestamp, fastest_lap_time):
+        self.timestamp = timestamp
+        self.lap_number = lap_number
+        self.lap_distance = lap_distance
+        self.total_distance = total_distance
+        self.pit_status = pit_status
+        self.position = position
+        self.result_status = result_status
+        self.penalties = penalties
+        self.safety_car_status = safety_car_status
+        self.fastest_lap_driver = fastest_lap_driver
+        self.fastest_lap_timestamp = fastest_lap_timestamp
+        self.fastest_lap_time = fastest_lap_time
+
+    def __len__(self):
+        return len(self.timestamp)
+
+
 class SafetyCarEvent:
     def __init__(self, status, timestamp):
         self.status = status
@@ -60,34 +85,34 @@ class FastestLapInfo:
         self.driver_idx = driver_idx
 
 
-def get_leader(packet):
-    return [i for i in range(len(packet.lapData)) if packet.lapData[i].carPosition == 1][0]
+def get_leader(lap_data):
+    return lap_data.position.index(1)
 
 
-def get_top_running_car(packet, num_laps):
+def get_top_running_car(lap_data, num_laps):
     leader = None
     leader_position = None
-    for i in range(len(packet.lapData)):
-        car = packet.lapData[i]
-        if car.carPosition <= 0:
+    for i in range(len(lap_data.position)):
+        position = lap_data.position[i]
+        if position <= 0:
             continue
-        if car.currentLapNum <= num_laps and (leader is None or car.carPosition < leader_position):
+        if lap_data.lap_number[i] <= num_laps and (leader is None or position < leader_position):
             leader = i
-            leader_position = car.carPosition
+            leader_position = position
             if leader_position == 1:
                 return leader
 
     if leader is None:
-        return get_leader(packet)
+        return get_leader(lap_data)
     else:
         return leader
 
 
 class LapInfo:
-    def __init__(self, pkt_id, packet, prev_lap):
-        leader = get_leader(packet)
-        self.lap_number = max([d.currentLapNum for d in packet.lapData])
-        self.driver_start_times = [None] * len(packet.lapData)
+    def __init__(self, pkt_id, lap_data, prev_lap):
+        leader = get_leader(lap_data)
+        self.lap_number = max(lap_data.lap_number)
+        self.driver_start_times = [None] * len(lap_data.lap_number)
         self.leader_at_start = leader
         self.driver_start_times[leader] = 0
         self.lap_duration = None
@@ -101,20 +126,20 @@ class LapInfo:
             self.start_timestamp = prev_lap.start_timestamp + prev_lap.lap_duration
         self.end_timestamp = self.start_timestamp
 
-    def update_drivers_status(self, packet):
+    def update_drivers_status(self, lap_data):
         if self.end_pkt_id is None:
-            leader = get_leader(packet)
-            self.lap_duration = packet.lapData[leader].currentLapTime + self.driver_start_times[leader]
+            leader = get_leader(lap_data)
+            self.lap_duration = lap_data.current_lap_time[leader] + self.driver_start_times[leader]
             self.end_timestamp = self.start_timestamp + self.lap_duration
-        for i in range(len(packet.lapData)):
-            if self.driver_start_times[i] is None and packet.lapData[i].currentLapNum == self.lap_number:
+        for i in range(len(lap_data.lap_number)):
+            if self.driver_start_times[i] is None and lap_data.lap_number[i] == self.lap_number:
                 self.driver_start_times[i] = self.lap_duration
 
     def end_lap(self, end_pkt_id):
         self.end_pkt_id = end_pkt_id
 
-    def add_event(self, packet):
-        self.events.append(packet)
+    def add_event(self, event):
+        self.events.append(event)
 
     def add_safety_car_event(self, status, timestamp):
         if len(self.safety_car_events) == 0 or self.safety_car_events[-1].status != status:
@@ -123,17 +148,133 @@ class LapInfo:
     def is_formation_lap(self):
         return len([e for e in self.safety_car_events if e.status == 3]) > 0
 
+    def to_json(self):
+        record = dict(vars(self))
+        record["events"] = [[event.code.decode("latin-1"), event.vehicle_idx, event.lap_time] for event in self.events]
+        record["safety_car_events"] = [[event.status, event.timestamp] for event in self.safety_car_events]
+        return record
+
+    @staticmethod
+    def from_json(record):
+        lap = LapInfo.__new__(LapInfo)
+        vars(lap).update(record)
+        lap.events = [EventRecord(code.encode("latin-1"), vehicle_idx, lap_time)
+                      for (code, vehicle_idx, lap_time) in record["events"]]
+        lap.safety_car_events = [SafetyCarEvent(status, timestamp)
+                                 for (status, timestamp) in record["safety_car_events"]]
+        return lap
+
     def __repr__(self):
         return str(vars(self))
 
 
+class SessionIndex:
+    # Laps of the session, built one packet at a time, either from a recording or as packets arrive
+    def __init__(self, cache=None):
+        self.track_length = None
+        self.num_laps = None
+        self.participants = None
+        self.final_classification = None
+        self.lap_infos = []
+        # Lap being recorded and the race lap it belongs to, None until the session starts
+        self.current_lap_info = None
+        self.current_lap = None
+        self.last_pkt_id = None
+        if cache is not None:
+            self.track_length = cache.track_length
+            self.num_laps = cache.total_laps
+            self.participants = self.load_participants(cache.participants)
+            if cache.final_classification is not None:
+                self.final_classification = [FinalClassification(*record)
+                                             for record in cache.final_classification]
+            # The laps only depend on the cache, they are built once and kept with it
+            if cache.laps is not None:
+                self.lap_infos = [LapInfo.from_json(lap) for lap in cache.laps]
+            else:
+                self.build(cache)
+                cache.save_laps([lap.to_json() for lap in self.lap_infos])
+
+    @staticmethod
+    def load_participants(participants):
+        drivers = participants["drivers"]
+        result = [ParticipantInfo(driver_id, team_id, race_number, name.encode("latin-1"))
+                  for (driver_id, team_id, race_number, name) in drivers]
+        for i in range(len(result)):
+            result[i].is_active = i < participants["num_active_cars"]
+        return result
+
+    def build(self, cache):
+        session_times = cache.session_time[cache.rows].tolist()
+        pkt_ids = cache.pkt_id[cache.rows].tolist()
+        packet_ids = cache.packet_id[cache.rows].tolist()
+        for row, timestamp, pkt_id, packet_id in zip(cache.rows, session_times, pkt_ids, packet_ids):
+            if packet_id == 1:
+                self.add_session(pkt_id, timestamp, int(cache.safety_car_status[row]))
+            elif packet_id == 2:
+                self.add_lap_data(pkt_id, cache.lap_row(row))
+            elif packet_id == 3:
+                self.add_event(pkt_id, cache.event(row))
+        self.end()
+
+    def add_event(self, pkt_id, event):
+        self.last_pkt_id = pkt_id
+        if event.code.decode() == "SSTA":
+            # Sometimes we see two SSTA one after the other, this is trying to handle that.
+            if self.current_lap_info and not self.current_lap_info.is_formation_lap():
+                self.current_lap_info = None
+                del self.lap_infos[-1]
+
+            self.current_lap = 0
+
+        if event.code.decode() == "SEND" and self.current_lap_info is not None:
+            self.current_lap_info.end_lap(pkt_id)
+            self.current_lap_info = None
+
+        if self.current_lap_info is not None:
+            self.current_lap_info.add_event(event)
+
+    def add_lap_data(self, pkt_id, lap_data):
+        self.last_pkt_id = pkt_id
+        if self.current_lap is None:
+            return
+
+        lap_infos = self.lap_infos
+        packet_lap = max(lap_data.lap_number)
+        running_cars = [lap_data.lap_number[i] for i in range(len(lap_data.lap_number))
+                        if lap_data.result_status[i] == 2]
+        if len(running_cars) == 0:
+            min_running_lap = packet_lap
+        else:
+            min_running_lap = min(running_cars)
+        # print(f"{min_running_lap} - {packet_lap}")
+        if packet_lap > self.current_lap:
+            if self.current_lap_info is not None:
+                self.current_lap_info.end_lap(pkt_id)
+            self.current_lap_info = LapInfo(pkt_id, lap_data, self.current_lap_info)
+            lap_infos.append(self.current_lap_info)
+            self.current_lap = packet_lap
+        for i in range(packet_lap - min_running_lap + 1):
+            # print(f"Updating lap {-i} status")
+            lap_infos[-1 - i].update_drivers_status(lap_data)
+
+    def add_session(self, pkt_id, timestamp, safety_car_status):
+        self.last_pkt_id = pkt_id
+        # Need this to track if the lap is a formation lap
+        if self.current_lap_info is not None:
+            self.current_lap_info.add_safety_car_event(safety_car_status, timestamp)
+
+    def end(self):
+        if self.current_lap_info is not None:
+            self.current_lap_info.end_lap(self.last_pkt_id)
+
+
 class Session:
     def __init__(self, filename, driver_filename):
         self.filename = filename
-        self.conn = sqlite3.connect(filename)
-        self.replay_cursor = None
+        self.conn = connect_read_only(filename)
+        self.cache = TelemetryCache.open(filename, self.conn)
+        self.index = SessionIndex(self.cache)
         self.flashbacks = self.identify_flashbacks()
-        self.delete_flashbacks()
         self.driver_names = self.load_driver_names(driver_filename)
 
         self.safety_car_status = None
@@ -142,169 +283,147 @@ class Session:
         self.chequered_flag = None
         self.active_participants = [p for p in self.get_participants_info() if p.is_active]
 
-        self.next_packet = None
+        self.next_row = None
+        # Replayed rows of the cache and the race duration after reading each of them, set by start_race_replay
+        self.replay_start = None
+        self.replay_rows = None
+        self.replay_durations = None
+        self.stop_durations = None
 
         self.laps = None
-        self.cursor = None
 
         self.num_laps = None
 
-    def get_record(self, query):
-        cursor = self.conn.cursor()
-        cursor.execute(query)
-        record = cursor.fetchone()
-        cursor.close()
-        return record
-
     def get_track_length(self):
-        query = "SELECT packet FROM packets WHERE packetId = 1 ORDER BY pkt_id;"
-        packet_bytes, = self.get_record(query)
-        packet = packets.unpack_udp_packet(packet_bytes)
-        return packet.trackLength
+        return self.index.track_length
 
     def get_participants_info(self):
-        query = "SELECT packet FROM packets WHERE packetId = 4 ORDER BY pkt_id;"
-        packet_bytes, = self.get_record(query)
-        packet = packets.unpack_udp_packet(packet_bytes)
-        participants = [ParticipantInfo(p.driverId, p.teamId, p.raceNumber, p.name) for p in packet.participants]
-        for i in range(len(participants)):
-            participants[i].is_active = i < packet.numActiveCars
-
+        participants = self.index.participants
+        i = len(participants) - 1
         for name in self.driver_names:
             participants[i].driver_name = name
 
-        return participants
+        return list(participants)
 
     def get_final_classification(self):
-        query = "SELECT packet FROM packets WHERE packetId = 8 ORDER BY pkt_id;"
-        packet_bytes, = self.get_record(query)
-        packet = packets.unpack_udp_packet(packet_bytes)
-        return [FinalClassification.from_packet(p) for p in packet.classificationData]
+        return list(self.index.final_classification)
 
     def get_number_of_laps(self):
-        query = "SELECT packet FROM packets WHERE packetId = 1 ORDER BY pkt_id;"
-        packet_bytes, = self.get_record(query)
-        packet = packets.unpack_udp_packet(packet_bytes)
-        return packet.totalLaps
+        return self.index.num_laps
 
     def identify_flashbacks(self):
-        cursor = self.conn.cursor()
-        query = "SELECT pkt_id, packet FROM packets WHERE packetId = 2 ORDER BY pkt_id;"
-        session_packets = []
-        flashbacks = []
-        cursor.execute(query)
-        record = cursor.fetchone()
-        while record is not None:
-            (pkt_id, packet_bytes) = record
-            packet = packets.unpack_udp_packet(packet_bytes)
-            flashback = len(session_packets) - 1
-            while flashback >= 0 and self.is_flashback(session_packets[flashback], (pkt_id, packet)):
-                flashback -= 1
-            if flashback != len(session_packets) - 1:
-                flashbacks.append((session_packets[flashback + 1][0], pkt_id))
-            session_packets.append((pkt_id, packet))
-            record = cursor.fetchone()
-        cursor.close()
-        return flashbacks
-
-    @staticmethod
-    def is_flashback(previous_record, record):
-        (pkt_id, packet) = record
-        (prev_pkt_id, prev_packet) = previous_record
-
-        for i in range(len(packet.lapData)):
-            ld = packet.lapData[i]
-            prev_ld = prev_packet.lapData[i]
-            if ld.resultStatus == 2 and prev_ld.resultStatus == 2:
-                if ld.currentLapNum < prev_ld.currentLapNum or \
-                        ld.currentLapNum == prev_ld.currentLapNum and ld.currentLapTime < prev_ld.currentLapTime:
-                    return True
-                else:
-                    return False
-
-    def delete_flashbacks(self):
-        for (pkt1, pkt2) in self.flashbacks:
-            cursor = self.conn.cursor()
-            query = f"DELETE FROM PACKETS WHERE pkt_id >= {pkt1} AND PKT_ID < {pkt2}"
-            cursor.execute(query)
-        self.conn.commit()
+        return list(self.cache.flashbacks)
 
     def get_lap_info(self):
-        cursor = self.conn.cursor()
-        query = "SELECT sessionTime, pkt_id, packetId, packet FROM packets WHERE packetId in (1, 2, 3) ORDER BY pkt_id;"
-        cursor.execute(query)
-        timestamped_packet = cursor.fetchone()
-        current_lap_info = None
-        lap_infos = []
-        current_lap = None
-
-        while timestamped_packet is not None:
-            (timestamp, pkt_id, packetId, packet_bytes) = timestamped_packet
-            packet = packets.unpack_udp_packet(packet_bytes)
-            if packetId == 3 and packet.eventStringCode.decode() == "SSTA":
-                # Sometimes we see two SSTA one after the other, this is trying to handle that.
-                if current_lap_info and not current_lap_info.is_formation_lap():
-                    current_lap_info = None
-                    del lap_infos[-1]
-
-                current_lap = 0
-
-            if packetId == 3 and packet.eventStringCode.decode() == "SEND":
-                current_lap_info.end_lap(pkt_id)
-                current_lap_info = None
-
-            if packetId == 2:
-                packet_lap = max([d.currentLapNum for d in packet.lapData])
-                running_cars = [d.currentLapNum for d in packet.lapData if d.resultStatus == 2]
-                if len(running_cars) == 0:
-                    min_running_lap = packet_lap
-                else:
-                    min_running_lap = min([d.currentLapNum for d in packet.lapData if d.resultStatus == 2])
-                # print(f"{min_running_lap} - {packet_lap}")
-                if packet_lap > current_lap:
-                    if current_lap_info is not None:
-                        current_lap_info.end_lap(pkt_id)
-                    current_lap_info = LapInfo(pkt_id, packet, current_lap_info)
-                    lap_infos.append(current_lap_info)
-                    current_lap = packet_lap
-                for i in range(packet_lap - min_running_lap + 1):
-                    # print(f"Updating lap {-i} status")
-                    lap_infos[-1 - i].update_drivers_status(packet)
-
-            # Need this to track if the lap is a formation lap
-            if packetId == 1:
-                if current_lap_info is not None:
-                    current_lap_info.add_safety_car_event(packet.safetyCarStatus, timestamp)
-
-            if packetId == 3:
-                if current_lap_info is not None:
-                    current_lap_info.add_event(packet)
-
-            timestamped_packet = cursor.fetchone()
-        if current_lap_info is not None:
-            current_lap_info.end_lap(pkt_id)
-        cursor.close()
-
-        return lap_infos
+        return list(self.index.lap_infos)
+
+    def get_replay_laps(self, skip_formation_lap):
+        laps = self.get_lap_info()
+        if laps[0].is_formation_lap():
+            del laps[0]
+        if skip_formation_lap:
+            laps = [lap for lap in laps if not lap.is_formation_lap()]
+        return laps
 
     def start_race_replay(self, skip_formation_lap):
-        self.laps = self.get_lap_info()
-        if self.laps[0].is_formation_lap():
-            del self.laps[0]
+        self.laps = self.get_replay_laps(skip_formation_lap)
         self.num_laps = self.get_number_of_laps()
-        if skip_formation_lap:
-            self.laps = [lap for lap in self.laps if not lap.is_formation_lap()]
         start_pkt_id = self.laps[0].start_pkt_id
-        self.cursor = self.conn.cursor()
-        query = f"SELECT sessionTime, pkt_id, packetId, packet FROM packets WHERE packetId IN (1, 2, 3) AND pkt_id > {start_pkt_id} ORDER BY pkt_id"
-        self.cursor.execute(query)
 
         self.safety_car_status = 0
         self.fastest_lap_info = None
         self.race_position = None
         self.chequered_flag = False
 
-        self.next_packet = self.cursor.fetchone()
+        self.next_row = self.cache.row_after(start_pkt_id)
+        self.replay_start = self.next_row
+        self.replay_rows = np.array(self.cache.rows[self.next_row:], dtype=np.int64)
+        self.replay_durations = self.get_replay_durations(self.replay_rows, self.laps, self.num_laps)
+        # skip_to_timestamp stops at the first packet whose race duration is not before the timestamp
+        self.stop_durations = np.maximum.accumulate(np.nan_to_num(self.replay_durations, nan=np.inf))
+        if self.next_row >= len(self.cache.rows):
+            self.next_row = None
+
+    def save_replay_state(self):
+        race_position = None if self.race_position is None else [copy.copy(car) for car in self.race_position]
+        return self.next_row, self.safety_car_status, self.fastest_lap_info, race_position, self.chequered_flag
+
+    def restore_replay_state(self, saved):
+        self.next_row, self.safety_car_status, self.fastest_lap_info, race_position, self.chequered_flag = saved
+        self.race_position = None if race_position is None else [copy.copy(car) for car in race_position]
+
+    def get_race_replay(self, skip_formation_lap):
+        laps = self.get_replay_laps(skip_formation_lap)
+        num_laps = self.get_number_of_laps()
+        cache = self.cache
+        rows = np.array(cache.rows[cache.row_after(laps[0].start_pkt_id):], dtype=np.int64)
+        is_lap_data = cache.packet_id[rows] == 2
+        lap_rows = rows[is_lap_data]
+        race_durations = self.get_race_durations(lap_rows, laps, num_laps)
+
+        # Index of the most recent lap data packet for every packet, starting from the first one
+        latest = np.cumsum(is_lap_data) - 1
+        replayed = latest >= 0
+        source = lap_rows[latest[replayed]]
+        timestamps = np.where(replayed, race_durations[latest], np.nan)
+
+        # Session and event packets read before the first lap data packet count as well
+        packet_ids = cache.packet_id[rows]
+        indices = np.arange(len(rows))
+        last_session = np.maximum.accumulate(np.where(packet_ids == 1, indices, -1))
+        safety_car_status = np.where(last_session >= 0, cache.safety_car_status[rows[last_session]], 0)
+
+        fastest_laps = [i for i in np.flatnonzero(packet_ids == 3).tolist()
+                        if cache.event(int(rows[i])).code.decode() == "FTLP"]
+        is_fastest_lap = np.zeros(len(rows), dtype=bool)
+        is_fastest_lap[fastest_laps] = True
+        last_fastest_lap = np.maximum.accumulate(np.where(is_fastest_lap, indices, -1))
+        drivers = np.full(len(rows), -1, dtype=np.int64)
+        lap_times = np.full(len(rows), np.nan)
+        for i in fastest_laps:
+            event = cache.event(int(rows[i]))
+            drivers[i] = event.vehicle_idx
+            lap_times[i] = event.lap_time
+        has_fastest_lap = last_fastest_lap >= 0
+
+        return RaceReplay(timestamps[replayed],
+                          cache.lap_number[source].astype(np.int64),
+                          cache.lap_distance[source].astype(np.float64),
+                          cache.total_distance[source].astype(np.float64),
+                          cache.pit_status[source],
+                          cache.position[source].astype(np.int64),
+                          cache.result_status[source],
+                          cache.penalties[source].astype(np.int64),
+                          safety_car_status[replayed],
+                          np.where(has_fastest_lap, drivers[last_fastest_lap], -1)[replayed],
+                          np.where(has_fastest_lap, timestamps[last_fastest_lap], np.nan)[replayed],
+                          np.where(has_fastest_lap, lap_times[last_fastest_lap], np.nan)[replayed])
+
+    def get_replay_durations(self, rows, laps, num_laps):
+        # Race duration after reading each of the rows, the one of the most recent lap data packet.  -inf before
+        # the first lap data packet.
+        is_lap_data = self.cache.packet_id[rows] == 2
+        race_durations = np.concatenate(([-np.inf], self.get_race_durations(rows[is_lap_data], laps, num_laps)))
+        return race_durations[np.cumsum(is_lap_data)]
+
+    def get_race_durations(self, lap_rows, laps, num_laps):
+        # Vectorized get_race_position: the race duration is taken from the top running car's lap time
+        cache = self.cache
+        positions = cache.position[lap_rows].astype(np.int64)
+        lap_numbers = cache.lap_number[lap_rows].astype(np.int64)
+        running = (positions > 0) & (lap_numbers <= num_laps)
+        leader = np.argmin(np.where(running, positions, np.iinfo(np.int64).max), axis=1)
+        no_running_car = ~running.any(axis=1)
+        leader[no_running_car] = np.argmax(positions[no_running_car] == 1, axis=1)
+
+        packets = np.arange(len(lap_rows))
+        lap_index = lap_numbers[packets, leader] - 1
+        lap_start_timestamps = np.array([lap.start_timestamp for lap in laps], dtype=np.float64)
+        driver_start_times = np.array([[np.nan if t is None else t for t in lap.driver_start_times] for lap in laps],
+                                      dtype=np.float64)
+        leader_current_lap_time = cache.current_lap_time[lap_rows, leader].astype(np.float64)
+        lap_duration = driver_start_times[lap_index, leader] + leader_current_lap_time
+        return lap_start_timestamps[lap_index] + lap_duration
 
     def get_current_race_position(self):
         return self.race_position
@@ -322,55 +441,55 @@ class Session:
     def get_current_race_duration(self):
         return self.get_race_duration(self.race_position)
 
-    def get_race_position(self, packet):
+    def get_race_position(self, lap_data):
         result = []
-        leader = get_top_running_car(packet, self.num_laps)
-        leader_lap = packet.lapData[leader].currentLapNum
+        leader = get_top_running_car(lap_data, self.num_laps)
+        leader_lap = lap_data.lap_number[leader]
         if leader_lap != self.laps[leader_lap - 1].lap_number:
             print(f"Blue hat, green hat: {leader_lap}")
         leader_lap_start_time = self.laps[leader_lap - 1].driver_start_times[leader]
-        leader_current_lap_time = packet.lapData[leader].currentLapTime
+        leader_current_lap_time = lap_data.current_lap_time[leader]
         lap_duration = leader_lap_start_time + leader_current_lap_time
         race_duration = self.laps[leader_lap - 1].start_timestamp + lap_duration
 
         # print(f"{time.time()} {current_lap} {leader} {leader_lap_start_time} {leader_current_lap_time} {lap_duration}")
 
-        for i in range(len(packet.lapData)):
-            lap_data = packet.lapData[i]
-            result.append(CarInfo(race_duration, lap_data.carPosition, lap_data.currentLapNum, lap_data.lapDistance,
-                                  lap_data.totalDistance, lap_data.pitStatus, lap_data.resultStatus,
-                                  lap_data.penalties))
+        for i in range(len(lap_data.lap_number)):
+            result.append(CarInfo(race_duration, lap_data.position[i], lap_data.lap_number[i],
+                                  lap_data.lap_distance[i], lap_data.total_distance[i], lap_data.pit_status[i],
+                                  lap_data.result_status[i], lap_data.penalties[i]))
         return result
 
     def read_next_packet(self):
-        if self.next_packet is None:
+        if self.next_row is None:
             return False # End of stream
 
-        (packet_timestamp, pkt_id, packet_id, packet_bytes) = self.next_packet
-        packet = packets.unpack_udp_packet(packet_bytes)
+        row = self.cache.rows[self.next_row]
+        packet_id = self.cache.packet_id[row]
         if packet_id == 1:
-            self.safety_car_status = packet.safetyCarStatus
+            self.safety_car_status = int(self.cache.safety_car_status[row])
 
         if packet_id == 3:
-            if packet.eventStringCode.decode() == "FTLP":
+            event = self.cache.event(row)
+            if event.code.decode() == "FTLP":
                 self.fastest_lap_info = FastestLapInfo(self.get_current_race_duration(),
-                                                       packet.eventDetails.fastestLap.lapTime,
-                                                       packet.eventDetails.fastestLap.vehicleIdx)
+                                                       event.lap_time,
+                                                       event.vehicle_idx)
 
-            if packet.eventStringCode == "CHQF":
+            if event.code == "CHQF":
                 self.chequered_flag = True
 
         if packet_id == 2:
-            self.race_position = self.get_race_position(packet)
+            self.race_position = self.get_race_position(self.cache.lap_row(row))
 
-        self.next_packet = self.cursor.fetchone()
-        if self.next_packet is None:
-            self.cursor.close()
+        self.next_row += 1
+        if self.next_row >= len(self.cache.rows):
+            self.next_row = None
 
         return True
 
     def skip_to_first_race_position(self):
-        if self.next_packet is None:
+        if self.next_row is None:
             return False # End of stream
 
         while self.race_position is None:
@@ -379,17 +498,45 @@ class Session:
         return self.race_position is not None
 
     def skip_to_timestamp(self, timestamp):
-        if self.next_packet is None:
+        if self.next_row is None:
             return False # End of stream
 
-        if self.get_current_race_duration() > timestamp:
+        if not self.get_current_race_duration() <= timestamp:
             return True
 
-        while self.get_current_race_duration() <= timestamp:
-            if not self.read_next_packet():
-                return False
+        # Same as reading packets until the race duration is past the timestamp, without decoding the race
+        # positions in between.  Timestamps only go back along with the replay position, so the packets read so far
+        # are all before this one, and the first packet of the replay past it is the one to stop at.
+        stop = int(np.searchsorted(self.stop_durations, timestamp, side="right"))
+        end = min(stop + 1, len(self.replay_rows))
+        self.read_packets(self.next_row - self.replay_start, end)
+        self.next_row = self.replay_start + end
+        if self.next_row >= len(self.cache.rows):
+            self.next_row = None
+        return stop < len(self.replay_rows)
+
+    def read_packets(self, start, end):
+        # read_next_packet for the replayed rows [start, end), only the last race position is decoded
+        cache = self.cache
+        rows = self.replay_rows[start:end]
+        packet_ids = cache.packet_id[rows]
+        session_rows = np.flatnonzero(packet_ids == 1)
+        if len(session_rows) > 0:
+            self.safety_car_status = int(cache.safety_car_status[rows[session_rows[-1]]])
+
+        for i in np.flatnonzero(packet_ids == 3).tolist():
+            event = cache.event(int(rows[i]))
+            if event.code.decode() == "FTLP":
+                self.fastest_lap_info = FastestLapInfo(float(self.replay_durations[start + i]),
+                                                       event.lap_time,
+                                                       event.vehicle_idx)
+
+            if event.code == "CHQF":
+                self.chequered_flag = True
 
-        return True
+        lap_rows = np.flatnonzero(packet_ids == 2)
+        if len(lap_rows) > 0:
+            self.race_position = self.get_race_position(cache.lap_row(int(rows[lap_rows[-1]])))
 
     def load_driver_names(self, driver_filename):
         if driver_filename is not None:
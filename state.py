@@ -1,10 +1,93 @@
+import copy
+
+import numpy as np
+
 import session
 import track_speed
 
+# A snapshot of the replay is kept every this many frames, so seeking never steps through more frames than that
+KEYFRAME_INTERVAL = 120
+
+
+class LeaderProgress:
+    # Total distance and race timestamp of the leader at every frame, in arrays that grow as needed
+    def __init__(self, capacity=1024):
+        self.distance = np.zeros(capacity)
+        self.timestamp = np.zeros(capacity)
+        self.length = 0
+        # The first sorted_length distances never go down
+        self.sorted_length = 0
+
+    def __len__(self):
+        return self.length
+
+    def append(self, distance, timestamp):
+        if self.length == len(self.distance):
+            self.distance = np.concatenate((self.distance, np.zeros(len(self.distance))))
+            self.timestamp = np.concatenate((self.timestamp, np.zeros(len(self.timestamp))))
+        if self.sorted_length == self.length and (self.length == 0 or distance >= self.distance[self.length - 1]):
+            self.sorted_length += 1
+        self.distance[self.length] = distance
+        self.timestamp[self.length] = timestamp
+        self.length += 1
+
+    def truncate(self, length):
+        self.length = length
+        self.sorted_length = min(self.sorted_length, length)
+
+    def latest_timestamp(self):
+        return self.timestamp[self.length - 1]
+
+    def advance(self, index, distance):
+        # Moves every car's index forward to the first leader position at or past the car's distance, stopping
+        # at the latest one.  Indexes never go back.
+        last = self.length - 1
+        if self.sorted_length == self.length:
+            found = np.searchsorted(self.distance[:self.length], distance, side="left")
+            return np.minimum(np.maximum(index, found), last)
+
+        # The lead changed to a car that is behind the previous leader, only walking forward finds the same index
+        index = index.copy()
+        while True:
+            moving = (self.distance[index] < distance) & (index < last)
+            if not moving.any():
+                return index
+            index += moving
+
+
+def interpolate(leader_distance, leader_timestamp, index, latest, distance):
+    # Time at which the leader was at each car's distance.  Index 0 pairs with the latest leader position,
+    # like index -1 does for a list.
+    previous = np.where(index == 0, latest, index - 1)
+    s1 = leader_distance[index]
+    s0 = leader_distance[previous]
+    t1 = leader_timestamp[index]
+    t0 = leader_timestamp[previous]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(s1 == s0, t1, t1 - (s1 - distance) * (t1 - t0) / (s1 - s0))
+
+
+def car_progress(lap_number, t, leader_timestamp, session_lap, lap_start, lap_durations, lap_end, num_laps):
+    # Race progress of every car, in laps, from the time the leader was at the car's distance
+    lap_index = np.where(lap_number < 1, lap_number - 1 + len(lap_start), lap_number - 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # If I'm in the same lap as the leader
+        leader_lap_time = leader_timestamp - lap_start[lap_index]
+        leader_lap_pct = leader_lap_time / lap_durations[lap_index]
+        time_delta = leader_timestamp - t
+        same_lap_pct = np.where(leader_lap_time > 0,
+                                leader_lap_pct * (leader_lap_time - time_delta) / leader_lap_time, 0)
+
+        lap_time = lap_durations[lap_index]
+        other_lap_pct = (lap_time - (lap_end[lap_index] - t)) / lap_time
+
+    progress = lap_number - 1 + np.where(lap_number == session_lap, same_lap_pct, other_lap_pct)
+    progress = np.where(progress < 0, 0, progress)
+    return np.where(progress > num_laps, num_laps, progress)
+
 
 class CarState:
     def __init__(self, car_idx, state):
-        self.delta_index = 0
         self.progress = 0
         self.car_idx = car_idx
         self.finished = False
@@ -41,54 +124,11 @@ class CarState:
     def final_time_with_penalties(self):
         return self.final_classification().final_time_with_penalties()
 
-    def update(self, leader_progress, lap_info, num_laps, session_lap):
-        car_info = self.state.cars[self.car_idx]
-        current_lap = car_info.lap_number
+    def save_state(self):
+        return self.progress, self.finished, self.is_spinning
 
-        self.is_spinning = self.state.speed_info.is_spinning(self.car_idx, car_info.timestamp)
-        self.is_spinning = self.is_spinning and not self.state.is_safety_car()
-
-        while leader_progress[self.delta_index][0] < car_info.total_distance \
-                and self.delta_index < len(leader_progress) - 1:
-            self.delta_index += 1
-
-        leader_timestamp = leader_progress[-1][1]
-        curr_lap_info = lap_info[current_lap - 1]
-
-        # If I'm in the same lap as the leader
-        if current_lap == session_lap:
-            leader_lap_time = leader_timestamp - curr_lap_info.start_timestamp
-            leader_lap_pct = leader_lap_time / curr_lap_info.lap_duration
-            t = self.interpolate(leader_progress, self.delta_index, car_info.total_distance)
-            time_delta = leader_timestamp - t
-            if leader_lap_time > 0:
-                my_lap_pct = leader_lap_pct * (leader_lap_time - time_delta) / leader_lap_time
-            else:
-                my_lap_pct = 0
-            self.progress = car_info.lap_number - 1 + my_lap_pct
-        else:
-            leader_lap_pct = 1
-            leader_lap_time = lap_info[car_info.lap_number - 1].lap_duration
-            t = self.interpolate(leader_progress, self.delta_index, car_info.total_distance)
-            time_delta = lap_info[car_info.lap_number - 1].end_timestamp - t
-            my_lap_pct = leader_lap_pct * (leader_lap_time - time_delta) / leader_lap_time
-            self.progress = car_info.lap_number - 1 + my_lap_pct
-        if self.progress < 0:
-            self.progress = 0
-        if self.progress > num_laps:
-            self.progress = num_laps
-
-    def interpolate(self, leader_progress, delta_index, total_distance):
-        s1 = leader_progress[delta_index][0]
-        s0 = leader_progress[delta_index - 1][0]
-        t1 = leader_progress[delta_index][1]
-        t0 = leader_progress[delta_index - 1][1]
-
-        if s1 == s0:
-            t = t1
-        else:
-            t = t1 - (s1 - total_distance) * (t1 - t0) / (s1 - s0)
-        return t
+    def restore_state(self, saved):
+        self.progress, self.finished, self.is_spinning = saved
 
 
 class GameState:
@@ -110,6 +150,9 @@ class GameState:
         if self.lap_info[0].is_formation_lap():
             self.formation_lap = self.lap_info[0]
             del self.lap_info[0]
+        self.lap_start = np.array([lap.start_timestamp for lap in self.lap_info], dtype=np.float64)
+        self.lap_durations = np.array([lap.lap_duration for lap in self.lap_info], dtype=np.float64)
+        self.lap_end = np.array([lap.end_timestamp for lap in self.lap_info], dtype=np.float64)
         self.current_frame = start_frame
         self.current_lap = 0
         self.fps = fps
@@ -125,9 +168,22 @@ class GameState:
             self.pre_frames = self.frames_per_lap
         self.post_frames = 0
         self.session_finished = False
-        self.leader_progress = []
+        self.leader_progress = LeaderProgress()
+        # Index of each car in the leader progress, where the leader was at the car's distance
+        self.delta_index = np.zeros(len(self.car_states), dtype=np.int64)
         self.is_chequered_flag = False
 
+        # Number of frames returned so far, and the saved states that seek() starts from
+        self.frame = 0
+        self.keyframe_interval = KEYFRAME_INTERVAL
+        self.keyframes = {0: self.save_state()}
+
+    def estimated_frame_count(self):
+        # Pre-frames, race frames and post-frames.  The race frames keep going until the recording runs out,
+        # which usually is a bit after the leader's last lap.
+        return (self.frames_per_lap - self.pre_frames) + (self.total_frames - self.current_frame) \
+            + 2 * self.frames_per_lap + 1
+
     def car_state(self, index):
         return self.car_states[index]
 
@@ -141,6 +197,60 @@ class GameState:
         return self.is_chequered_flag
 
     def next_frame(self):
+        if not self.step():
+            return False
+        self.frame += 1
+        if self.frame % self.keyframe_interval == 0 and self.frame not in self.keyframes:
+            self.keyframes[self.frame] = self.save_state()
+        return True
+
+    def seek(self, frame):
+        # Moves to the given frame, as if next_frame() had been called that many times.  Returns False if the
+        # race ends before that.
+        keyframe = max(k for k in self.keyframes if k <= frame)
+        if not keyframe <= self.frame <= frame:
+            self.restore_keyframe(keyframe)
+        while self.frame < frame:
+            if not self.next_frame():
+                return False
+        return True
+
+    def restore_keyframe(self, frame):
+        self.restore_state(self.keyframes[frame])
+
+    def save_state(self):
+        # Car infos are copied because finished cars get their position updated in place
+        return {
+            "frame": self.frame,
+            "current_frame": self.current_frame,
+            "current_lap": self.current_lap,
+            "current_timestamp": self.current_timestamp,
+            "session_progress": self.session_progress,
+            "player_timestamp": self.player_timestamp,
+            "pre_frames": self.pre_frames,
+            "post_frames": self.post_frames,
+            "session_finished": self.session_finished,
+            "is_chequered_flag": self.is_chequered_flag,
+            "leader_progress": len(self.leader_progress),
+            "delta_index": self.delta_index.copy(),
+            "cars": [copy.copy(car) for car in self.cars],
+            "car_states": [car_state.save_state() for car_state in self.car_states],
+            "session": self.session.save_replay_state(),
+        }
+
+    def restore_state(self, saved):
+        for name in ["frame", "current_frame", "current_lap", "current_timestamp", "session_progress",
+                     "player_timestamp", "pre_frames", "post_frames", "session_finished", "is_chequered_flag"]:
+            setattr(self, name, saved[name])
+        # The leader progress only ever grows, every keyframe is a prefix of it
+        self.leader_progress.truncate(saved["leader_progress"])
+        self.delta_index = saved["delta_index"].copy()
+        self.cars = [copy.copy(car) for car in saved["cars"]]
+        for car_state, car_state_saved in zip(self.car_states, saved["car_states"]):
+            car_state.restore_state(car_state_saved)
+        self.session.restore_replay_state(saved["session"])
+
+    def step(self):
         if self.pre_frames < self.frames_per_lap:
             self.pre_frames += 1
             return True
@@ -182,20 +292,27 @@ class GameState:
 
         self.update_leader_progress()
 
-        for i in range(len(self.car_states)):
-            self.car_states[i].update(self.leader_progress, self.lap_info, self.num_laps, self.current_lap)
+        self.update_car_states()
 
         return True
 
     def update_leader_progress(self):
-        leader = [car for car in self.cars if car.position == 1][0]
-        self.leader_progress.append((leader.total_distance, leader.timestamp, leader.lap_distance))
-
-
-
-
-
-
-
-
-
+        leader = next(car for car in self.cars if car.position == 1)
+        self.leader_progress.append(leader.total_distance, leader.timestamp)
+
+    def update_car_states(self):
+        lap_number = np.array([car.lap_number for car in self.cars], dtype=np.int64)
+        total_distance = np.array([car.total_distance for car in self.cars], dtype=np.float64)
+
+        leader_progress = self.leader_progress
+        self.delta_index = leader_progress.advance(self.delta_index, total_distance)
+        t = interpolate(leader_progress.distance, leader_progress.timestamp, self.delta_index,
+                        len(leader_progress) - 1, total_distance)
+        progress = car_progress(lap_number, t, leader_progress.latest_timestamp(), self.current_lap,
+                                self.lap_start, self.lap_durations, self.lap_end, self.num_laps).tolist()
+
+        is_safety_car = self.is_safety_car()
+        for i, car_state in enumerate(self.car_states):
+            car_state.progress = progress[i]
+            is_spinning = self.speed_info.is_spinning(i, self.cars[i].timestamp)
+            car_state.is_spinning = is_spinning and not is_safety_car
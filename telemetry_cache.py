@@ -0,0 +1,346 @@
+import ctypes
+import glob
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import pathlib
+import shutil
+import sqlite3
+
+import numpy as np
+import f1_2020_telemetry.packets as packets
+from flashbacks import FlashbackDetector, merge_ranges
+
+CACHE_VERSION = 3
+NUM_CARS = 22
+IMPORT_BATCH_SIZE = 10000
+# Session, lap data, event, participants and final classification packets
+IMPORTED_PACKETS = (1, 2, 3, 4, 8)
+# Recordings are read through a memory map instead of copying every page into SQLite's page cache
+SQLITE_MMAP_SIZE = 1 << 30
+HASH_SAMPLE_SIZE = 1 << 20
+USER_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "raceviewer")
+
+LAP_FIELDS = {
+    "lap_number": "currentLapNum",
+    "lap_distance": "lapDistance",
+    "total_distance": "totalDistance",
+    "current_lap_time": "currentLapTime",
+    "position": "carPosition",
+    "pit_status": "pitStatus",
+    "result_status": "resultStatus",
+    "penalties": "penalties",
+}
+
+
+def struct_dtype(struct, names, formats=None):
+    # Builds a numpy dtype that views only the given fields of a packed ctypes structure,
+    # so a batch of raw packets can be decoded with a single np.frombuffer call.
+    formats = formats or {}
+    field_types = dict(struct._fields_)
+    return np.dtype({
+        "names": names,
+        "formats": [formats.get(name, np.dtype(field_types[name]).newbyteorder("<")) for name in names],
+        "offsets": [getattr(struct, name).offset for name in names],
+        "itemsize": ctypes.sizeof(struct),
+    })
+
+
+LAP_DATA_DTYPE = struct_dtype(packets.LapData_V1, list(LAP_FIELDS.values()))
+LAP_PACKET_DTYPE = struct_dtype(packets.PacketLapData_V1, ["lapData"], {"lapData": (LAP_DATA_DTYPE, NUM_CARS)})
+SESSION_PACKET_DTYPE = struct_dtype(packets.PacketSessionData_V1, ["totalLaps", "trackLength", "safetyCarStatus"])
+
+
+def file_key(filename):
+    # Hashing a multi-GB recording on every open would cost more than the decode we are trying to avoid,
+    # so the key covers the file size, modification time and the first and last megabyte of content.
+    stat = os.stat(filename)
+    digest = hashlib.sha1(f"{CACHE_VERSION}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    with open(filename, "rb") as file:
+        digest.update(file.read(HASH_SAMPLE_SIZE))
+        if stat.st_size > HASH_SAMPLE_SIZE:
+            file.seek(max(HASH_SAMPLE_SIZE, stat.st_size - HASH_SAMPLE_SIZE))
+            digest.update(file.read(HASH_SAMPLE_SIZE))
+    return digest.hexdigest()[:16]
+
+
+def connect_read_only(filename):
+    uri = pathlib.Path(filename).absolute().as_uri() + "?mode=ro"
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE};")
+    return conn
+
+
+def has_packet_type_index(conn):
+    # Recordings written by recorder.py and compact.py are indexed on (packetId, pkt_id)
+    for index in conn.execute("PRAGMA index_list(packets);").fetchall():
+        columns = [row[2] for row in conn.execute(f"PRAGMA index_info(\"{index[1]}\");")]
+        if columns[:2] == ["packetId", "pkt_id"]:
+            return True
+    return False
+
+
+def packet_cursors(conn):
+    # Cursors over the imported packets, each in pkt_id order.  SQLite would sort the rows of all the packet types
+    # read through the index in a temporary table, merging one cursor for each type avoids that.  Without the
+    # index, a single scan of the table is fastest.
+    query = "SELECT pkt_id, packetId, sessionTime, packet FROM packets WHERE packetId {} ORDER BY pkt_id;"
+    if has_packet_type_index(conn):
+        return [conn.execute(query.format("= ?"), (packet_id,)) for packet_id in IMPORTED_PACKETS]
+    return [conn.execute(query.format(f"IN {IMPORTED_PACKETS}"))]
+
+
+def fetch_rows(cursor):
+    # Rows of the cursor, fetched from SQLite in batches
+    return itertools.chain.from_iterable(iter(lambda: cursor.fetchmany(IMPORT_BATCH_SIZE), []))
+
+
+def cache_dir(directory, name, key):
+    return os.path.join(directory, f"{name}.{key}.cache")
+
+
+def cache_locations(filename):
+    # Recordings on a read-only mount get their cache in the user's cache directory instead.  Caches there are also
+    # named after the recording's directory, recordings with the same name in other directories have their own.
+    directory = os.path.dirname(os.path.abspath(filename))
+    name = os.path.basename(filename)
+    directory_hash = hashlib.sha1(directory.encode()).hexdigest()[:8]
+    return [(directory, name), (USER_CACHE_DIR, f"{name}.{directory_hash}")]
+
+
+def load_array(path):
+    # Empty files cannot be memory-mapped.  Indexing a plain array view of the map is faster than a memmap.
+    array = np.load(path, mmap_mode="r")
+    if array.size == 0:
+        return np.load(path)
+    return np.asarray(array)
+
+
+class LapDataRow:
+    def __init__(self, cache, row):
+        self.lap_number = cache.lap_number[row].tolist()
+        self.lap_distance = cache.lap_distance[row].tolist()
+        self.total_distance = cache.total_distance[row].tolist()
+        self.current_lap_time = cache.current_lap_time[row].tolist()
+        self.position = cache.position[row].tolist()
+        self.pit_status = cache.pit_status[row].tolist()
+        self.result_status = cache.result_status[row].tolist()
+        self.penalties = cache.penalties[row].tolist()
+
+    def __repr__(self):
+        return str(vars(self))
+
+
+class EventRecord:
+    def __init__(self, code, vehicle_idx, lap_time):
+        self.code = code
+        self.vehicle_idx = vehicle_idx
+        self.lap_time = lap_time
+
+    def __repr__(self):
+        return str(vars(self))
+
+
+class TelemetryCache:
+    ARRAYS = ["pkt_id", "packet_id", "session_time", "safety_car_status",
+              "event_row", "event_code", "event_vehicle", "event_lap_time"] + list(LAP_FIELDS)
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as file:
+            meta = json.load(file)
+        self.meta = meta
+        self.track_length = meta["track_length"]
+        self.total_laps = meta["total_laps"]
+        self.participants = meta["participants"]
+        self.final_classification = meta["final_classification"]
+        self.flashbacks = [tuple(flashback) for flashback in meta["flashbacks"]]
+        # Built by the session the first time the cache is opened
+        self.laps = meta.get("laps")
+        for name in self.ARRAYS:
+            setattr(self, name, load_array(os.path.join(path, f"{name}.npy")))
+
+        # Flashbacks are never removed from the recording, the replay just skips over them
+        self.excluded = np.zeros(len(self.pkt_id), dtype=bool)
+        for (start_pkt_id, end_pkt_id) in self.flashbacks:
+            start, end = np.searchsorted(self.pkt_id, [start_pkt_id, end_pkt_id])
+            self.excluded[start:end] = True
+        self.rows = np.flatnonzero(~self.excluded).tolist()
+        self.events = {row: EventRecord(bytes(code), vehicle, lap_time) for row, code, vehicle, lap_time
+                       in zip(self.event_row.tolist(), self.event_code.tolist(),
+                              self.event_vehicle.tolist(), self.event_lap_time.tolist())}
+
+    def __len__(self):
+        return len(self.pkt_id)
+
+    def lap_row(self, row):
+        return LapDataRow(self, row)
+
+    def event(self, row):
+        return self.events[row]
+
+    def row_after(self, pkt_id):
+        # Position in self.rows of the first replayed packet after pkt_id
+        return int(np.searchsorted(self.pkt_id[self.rows], pkt_id, side="right"))
+
+    def save_laps(self, laps):
+        self.laps = laps
+        self.meta["laps"] = laps
+        filename = os.path.join(self.path, "meta.json")
+        tmp_filename = f"{filename}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_filename, "w") as file:
+                json.dump(self.meta, file)
+            os.replace(tmp_filename, filename)
+        except OSError:
+            # The laps are built again the next time
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+
+    @staticmethod
+    def open(filename, conn=None):
+        key = file_key(filename)
+        locations = cache_locations(filename)
+        paths = [cache_dir(directory, name, key) for (directory, name) in locations]
+        for path in paths:
+            if os.path.isdir(path):
+                return TelemetryCache(path)
+
+        if conn is None:
+            conn = connect_read_only(filename)
+        arrays, meta = TelemetryCache.build(conn)
+        error = None
+        for (directory, name), path in zip(locations, paths):
+            try:
+                TelemetryCache.write(path, arrays, meta)
+            except OSError as e:
+                error = e
+                continue
+            # Only keys match the wildcards, not the caches of recordings whose name starts with this one
+            pattern = cache_dir(glob.escape(directory), glob.escape(name), "?" * len(key))
+            for stale in glob.glob(pattern):
+                if stale != path:
+                    shutil.rmtree(stale, ignore_errors=True)
+            return TelemetryCache(path)
+        raise error
+
+    @staticmethod
+    def build(conn):
+        columns = {name: [] for name in TelemetryCache.ARRAYS}
+        meta = {"version": CACHE_VERSION, "track_length": None, "total_laps": None,
+                "participants": None, "final_classification": None}
+        detector = FlashbackDetector()
+        num_rows = 0
+
+        cursors = packet_cursors(conn)
+        rows = heapq.merge(*[fetch_rows(cursor) for cursor in cursors])
+        batch = list(itertools.islice(rows, IMPORT_BATCH_SIZE))
+        while batch:
+            # Participants and final classification are only needed once, they are kept in the metadata
+            # instead of the per-packet replay columns.
+            records = []
+            for record in batch:
+                if record[1] == 4 and meta["participants"] is None:
+                    meta["participants"] = TelemetryCache.decode_participants(record[3])
+                elif record[1] == 8 and meta["final_classification"] is None:
+                    meta["final_classification"] = TelemetryCache.decode_final_classification(record[3])
+                elif record[1] in (1, 2, 3):
+                    records.append(record)
+            batch = list(itertools.islice(rows, IMPORT_BATCH_SIZE))
+            if not records:
+                continue
+
+            pkt_ids, packet_ids, session_times, blobs = zip(*records)
+            packet_ids = np.array(packet_ids, dtype=np.uint8)
+            columns["pkt_id"].append(np.array(pkt_ids, dtype=np.int64))
+            columns["packet_id"].append(packet_ids)
+            columns["session_time"].append(np.array(session_times, dtype=np.float64))
+
+            lap_rows = np.flatnonzero(packet_ids == 2)
+            lap_data = np.zeros((len(records), NUM_CARS), dtype=LAP_DATA_DTYPE)
+            lap_data[lap_rows] = TelemetryCache.decode(blobs, lap_rows, LAP_PACKET_DTYPE)["lapData"]
+            for name, field in LAP_FIELDS.items():
+                columns[name].append(np.ascontiguousarray(lap_data[field]))
+            for (pkt_id, result_status, lap_number, current_lap_time) in zip(
+                    np.asarray(pkt_ids)[lap_rows].tolist(), lap_data["resultStatus"][lap_rows].tolist(),
+                    lap_data["currentLapNum"][lap_rows].tolist(), lap_data["currentLapTime"][lap_rows].tolist()):
+                detector.add(pkt_id, result_status, lap_number, current_lap_time)
+
+            session_rows = np.flatnonzero(packet_ids == 1)
+            safety_car_status = np.full(len(records), -1, dtype=np.int8)
+            if len(session_rows) > 0:
+                session_data = TelemetryCache.decode(blobs, session_rows, SESSION_PACKET_DTYPE)
+                safety_car_status[session_rows] = session_data["safetyCarStatus"]
+                if meta["track_length"] is None:
+                    meta["track_length"] = int(session_data["trackLength"][0])
+                    meta["total_laps"] = int(session_data["totalLaps"][0])
+            columns["safety_car_status"].append(safety_car_status)
+
+            for row in np.flatnonzero(packet_ids == 3).tolist():
+                packet = packets.unpack_udp_packet(blobs[row])
+                columns["event_row"].append(num_rows + row)
+                columns["event_code"].append(packet.eventStringCode)
+                columns["event_vehicle"].append(packet.eventDetails.fastestLap.vehicleIdx)
+                columns["event_lap_time"].append(packet.eventDetails.fastestLap.lapTime)
+
+            num_rows += len(records)
+        for cursor in cursors:
+            cursor.close()
+        meta["flashbacks"] = merge_ranges(detector.flashbacks)
+
+        arrays = {
+            "event_row": np.array(columns.pop("event_row"), dtype=np.int64),
+            "event_code": np.array(columns.pop("event_code"), dtype="S4"),
+            "event_vehicle": np.array(columns.pop("event_vehicle"), dtype=np.uint8),
+            "event_lap_time": np.array(columns.pop("event_lap_time"), dtype=np.float32),
+        }
+        for name, chunks in columns.items():
+            if chunks:
+                arrays[name] = np.concatenate(chunks)
+            elif name in LAP_FIELDS:
+                arrays[name] = np.zeros((0, NUM_CARS), dtype=LAP_DATA_DTYPE[LAP_FIELDS[name]])
+            else:
+                arrays[name] = np.zeros(0, dtype=np.float64 if name == "session_time" else np.int64)
+        return arrays, meta
+
+    @staticmethod
+    def write(path, arrays, meta):
+        # Write to a temporary directory and rename it so that an interrupted import never leaves
+        # a partial cache behind.
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, f"{name}.npy"), array)
+        with open(os.path.join(tmp_path, "meta.json"), "w") as file:
+            json.dump(meta, file)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process finished importing the same file first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @staticmethod
+    def decode_participants(blob):
+        packet = packets.unpack_udp_packet(blob)
+        return {
+            "num_active_cars": packet.numActiveCars,
+            # Names are kept as the raw bytes sent by the game
+            "drivers": [[p.driverId, p.teamId, p.raceNumber, p.name.decode("latin-1")] for p in packet.participants],
+        }
+
+    @staticmethod
+    def decode_final_classification(blob):
+        packet = packets.unpack_udp_packet(blob)
+        return [[p.position, p.numLaps, p.totalRaceTime, p.penaltiesTime] for p in packet.classificationData]
+
+    @staticmethod
+    def decode(blobs, rows, dtype):
+        selected = [blobs[row] for row in rows.tolist()]
+        for blob in selected:
+            if len(blob) != dtype.itemsize:
+                # Let the telemetry library report the unexpected packet format
+                packets.unpack_udp_packet(blob)
+        return np.frombuffer(b"".join(selected), dtype=dtype)
@@ -1,7 +1,43 @@
+import collections
+
 import pygame
 
+TEXT_CACHE_SIZE = 256
+
+
+class TextCache:
+    # Rendered text surfaces, keyed by everything that changes how they look, dropping the least recently used ones.
+    # The surfaces are shared, so they must not be drawn on.
+    def __init__(self, capacity=TEXT_CACHE_SIZE):
+        self.capacity = capacity
+        self.surfaces = collections.OrderedDict()
+
+    def get(self, key):
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+        return surface
+
+    def put(self, key, surface):
+        self.surfaces[key] = surface
+        self.surfaces.move_to_end(key)
+        while len(self.surfaces) > self.capacity:
+            self.surfaces.popitem(last=False)
+
+
+text_cache = TextCache()
+
 
 def prepare_text(text, font, fg_color, bg_color=None, width=None, height=None, border=0):
+    key = (text, font, fg_color, bg_color, width, height, border)
+    text_surf = text_cache.get(key)
+    if text_surf is None:
+        text_surf = render_text(text, font, fg_color, bg_color, width, height, border)
+        text_cache.put(key, text_surf)
+    return text_surf
+
+
+def render_text(text, font, fg_color, bg_color=None, width=None, height=None, border=0):
     text_img = font.render(text, True, fg_color)
     if bg_color is None and width is None and height is None:
         return text_img
@@ -0,0 +1,266 @@
+import os
+
+import numpy as np
+
+import state
+import track_speed
+from session import CarInfo, FastestLapInfo
+
+TIMELINE_VERSION = 1
+
+# Race position fields of every car, as they would be found in GameState.cars
+CAR_FIELDS = ["timestamp", "position", "lap_number", "lap_distance", "total_distance", "pit_status",
+              "result_status", "penalties"]
+CAR_STATE_FIELDS = ["progress", "finished", "is_spinning"]
+STEP_FIELDS = ["session_progress", "player_timestamp", "safety_car", "chequered_flag",
+               "fastest_lap_driver", "fastest_lap_timestamp", "fastest_lap_time"]
+
+
+class Timeline:
+    # Everything GameState computes for the renderer, for every step of the replay at once.  Steps are the
+    # frames in which the replay moves: step 0 is the state before the race starts, shown during the
+    # pre-frames, and the last step is repeated during the post-frames.
+    def __init__(self, arrays, pre_frames, post_frames):
+        self.pre_frames = pre_frames
+        self.post_frames = post_frames
+        for name in CAR_FIELDS + CAR_STATE_FIELDS + STEP_FIELDS:
+            setattr(self, name, arrays[name])
+
+    def num_steps(self):
+        return len(self.session_progress)
+
+    def frame_count(self):
+        return self.pre_frames + self.num_steps() + self.post_frames
+
+    def step(self, frame):
+        return min(max(frame - self.pre_frames, 0), self.num_steps() - 1)
+
+    @staticmethod
+    def build(session, fps, lap_duration, start_frame=0):
+        num_laps = session.get_number_of_laps()
+        lap_info = session.get_lap_info()
+        if lap_info[0].is_formation_lap():
+            del lap_info[0]
+        frames_per_lap = fps * lap_duration
+        replay = session.get_race_replay(skip_formation_lap=True)
+        speed_info = track_speed.TrackSpeed(session)
+
+        current_frame, cursor = Timeline.replay_cursor(replay, lap_info, num_laps, fps, frames_per_lap,
+                                                       start_frame)
+        current_frame = np.concatenate(([start_frame], current_frame))
+        cursor = np.concatenate(([0], cursor))
+
+        # GameState.next_frame, one step at a time
+        current_lap = np.trunc(current_frame / frames_per_lap).astype(np.int64)
+        chequered_flag = current_lap >= num_laps
+        current_lap = np.minimum(current_lap, num_laps - 1)
+        lap_start = np.array([lap.start_timestamp for lap in lap_info], dtype=np.float64)
+        lap_durations = np.array([lap.lap_duration for lap in lap_info], dtype=np.float64)
+        lap_end = np.array([lap.end_timestamp for lap in lap_info], dtype=np.float64)
+        progress_in_lap = (current_frame - frames_per_lap * current_lap).astype(np.float64) / float(frames_per_lap)
+        session_progress = (progress_in_lap + current_lap.astype(np.float64)) / float(num_laps)
+        player_timestamp = current_frame.astype(np.float64) / float(fps)
+        session_progress[0] = 0
+        player_timestamp[0] = 0
+        chequered_flag[0] = False
+
+        arrays = Timeline.race_positions(replay, cursor, chequered_flag, num_laps)
+
+        safety_car = replay.safety_car_status[cursor] != 0
+        arrays["is_spinning"] = np.zeros(arrays["timestamp"].shape, dtype=bool)
+        for i in range(arrays["timestamp"].shape[1]):
+            arrays["is_spinning"][1:, i] = speed_info.spins[i].is_happening_many(arrays["timestamp"][1:, i])
+        arrays["is_spinning"] &= ~safety_car[:, np.newaxis]
+
+        arrays["progress"] = Timeline.car_progress(arrays, current_lap, num_laps, lap_start, lap_durations, lap_end)
+        arrays["session_progress"] = session_progress
+        arrays["player_timestamp"] = player_timestamp
+        arrays["safety_car"] = safety_car
+        arrays["chequered_flag"] = chequered_flag
+        arrays["fastest_lap_driver"] = replay.fastest_lap_driver[cursor]
+        arrays["fastest_lap_timestamp"] = replay.fastest_lap_timestamp[cursor]
+        arrays["fastest_lap_time"] = replay.fastest_lap_time[cursor]
+
+        pre_frames = frames_per_lap if start_frame == 0 else 0
+        return Timeline(arrays, pre_frames, frames_per_lap * 2)
+
+    @staticmethod
+    def replay_cursor(replay, lap_info, num_laps, fps, frames_per_lap, start_frame):
+        # Replayed packet after every step, until the step that runs out of packets.  skip_to_timestamp stops at
+        # the first packet whose race duration is past the frame timestamp, and frame timestamps never go
+        # back, so the first such packet of the whole replay is the one it stops at.
+        race_durations = np.maximum.accumulate(replay.timestamp)
+        last = len(replay) - 1
+        lap_start = np.array([lap.start_timestamp for lap in lap_info], dtype=np.float64)
+        lap_durations = np.array([lap.lap_duration for lap in lap_info], dtype=np.float64)
+
+        steps = max(frames_per_lap * num_laps - start_frame, 0) + frames_per_lap
+        while True:
+            current_frame = start_frame + np.arange(1, steps + 1)
+            current_lap = np.minimum(np.trunc(current_frame / frames_per_lap).astype(np.int64), num_laps - 1)
+            progress_in_lap = (current_frame - frames_per_lap * current_lap).astype(np.float64) \
+                / float(frames_per_lap)
+            timestamps = lap_start[current_lap] + lap_durations[current_lap] * progress_in_lap
+            cursor = np.searchsorted(race_durations, timestamps, side="right")
+            previous = np.concatenate(([0], np.minimum(cursor[:-1], last)))
+            finished = (previous == last) | (cursor > last)
+            if finished.any():
+                steps = int(np.argmax(finished)) + 1
+                return current_frame[:steps], np.minimum(cursor[:steps], last)
+            steps *= 2
+
+    @staticmethod
+    def race_positions(replay, cursor, chequered_flag, num_laps):
+        # GameState.cars for every step.  A finished car keeps the race position it had before crossing the
+        # line, except for its position in the classification, which keeps updating from the next step on.
+        lap_number = replay.lap_number[cursor]
+        steps = np.arange(len(cursor))[:, np.newaxis]
+        crossed = np.zeros(lap_number.shape, dtype=bool)
+        crossed[1:] = (lap_number[1:] > lap_number[:-1]) & chequered_flag[1:, np.newaxis] \
+            | (lap_number[1:] > num_laps)
+        finish_step = np.where(crossed.any(axis=0), np.argmax(crossed, axis=0), len(cursor))
+        finished = steps >= finish_step
+        source = np.where(finished, finish_step - 1, steps)
+        cars = np.arange(lap_number.shape[1])
+
+        arrays = {"finished": finished}
+        for name in CAR_FIELDS:
+            if name == "timestamp":
+                values = replay.timestamp[cursor[source]]
+            else:
+                values = getattr(replay, name)[cursor[source], cars]
+            arrays[name] = values
+        position_source = np.where(steps == finish_step, finish_step - 1, steps)
+        arrays["position"] = replay.position[cursor[position_source], cars]
+        return arrays
+
+    @staticmethod
+    def car_progress(arrays, current_lap, num_laps, lap_start, lap_durations, lap_end):
+        # GameState.update_car_states for every step
+        timestamp = arrays["timestamp"]
+        total_distance = arrays["total_distance"]
+        num_steps, num_cars = timestamp.shape
+        progress = np.zeros(timestamp.shape)
+        if num_steps == 1:
+            return progress
+
+        # GameState.update_leader_progress
+        steps = np.arange(num_steps - 1)
+        leader = np.argmax(arrays["position"][1:] == 1, axis=1)
+        leader_distance = total_distance[1:][steps, leader]
+        leader_timestamp = timestamp[1:][steps, leader]
+
+        # The index into the leader progress only moves forward, which makes it depend on all previous steps
+        leader_progress = state.LeaderProgress(num_steps)
+        delta_index = np.zeros((num_steps - 1, num_cars), dtype=np.int64)
+        index = np.zeros(num_cars, dtype=np.int64)
+        for step in range(1, num_steps):
+            leader_progress.append(leader_distance[step - 1], leader_timestamp[step - 1])
+            index = leader_progress.advance(index, total_distance[step])
+            delta_index[step - 1] = index
+
+        t = state.interpolate(leader_distance, leader_timestamp, delta_index, steps[:, np.newaxis],
+                              total_distance[1:])
+        progress[1:] = state.car_progress(arrays["lap_number"][1:], t, leader_timestamp[:, np.newaxis],
+                                          current_lap[1:, np.newaxis], lap_start, lap_durations, lap_end, num_laps)
+        return progress
+
+    def save(self, filename, key):
+        arrays = {name: getattr(self, name) for name in CAR_FIELDS + CAR_STATE_FIELDS + STEP_FIELDS}
+        tmp_filename = f"{filename}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_filename, version=TIMELINE_VERSION, key=key, pre_frames=self.pre_frames,
+                 post_frames=self.post_frames, **arrays)
+        os.replace(tmp_filename, filename)
+
+    @staticmethod
+    def load(filename, key):
+        # Returns None if the file is missing or was saved for a different race or frame rate
+        if not os.path.exists(filename):
+            return None
+        with np.load(filename) as data:
+            if int(data["version"]) != TIMELINE_VERSION or str(data["key"]) != key:
+                return None
+            arrays = {name: data[name] for name in CAR_FIELDS + CAR_STATE_FIELDS + STEP_FIELDS}
+            return Timeline(arrays, int(data["pre_frames"]), int(data["post_frames"]))
+
+    @staticmethod
+    def open(filename, session, fps, lap_duration, start_frame=0):
+        key = f"{os.path.basename(session.cache.path)}:{fps}:{lap_duration}:{start_frame}"
+        timeline = Timeline.load(filename, key)
+        if timeline is None:
+            timeline = Timeline.build(session, fps, lap_duration, start_frame)
+            timeline.save(filename, key)
+        return timeline
+
+
+class TimelineState:
+    # Same interface as GameState for the renderer, reading every frame from a Timeline
+    def __init__(self, session, timeline):
+        self.timeline = timeline
+        self.num_laps = session.get_number_of_laps()
+        self.track_length = session.get_track_length()
+        self.final_classification = session.get_final_classification()
+        self.participants = session.get_participants_info()
+        self.car_states = [state.CarState(i, self) for (i, car) in enumerate(self.participants)]
+        self.cars = None
+        self.session_progress = 0
+        self.player_timestamp = 0
+        self.fastest_lap_info = None
+
+        # Every frame can be read directly, the interval only sets how often the renderer saves its own state
+        self.frame = 0
+        self.keyframe_interval = state.KEYFRAME_INTERVAL
+        self.keyframes = range(timeline.frame_count())
+        self.load_frame(0)
+
+    def estimated_frame_count(self):
+        return self.timeline.frame_count()
+
+    def car_state(self, index):
+        return self.car_states[index]
+
+    def is_safety_car(self):
+        return bool(self.timeline.safety_car[self.timeline.step(self.frame)])
+
+    def fastest_lap(self):
+        return self.fastest_lap_info
+
+    def chequered_flag(self):
+        return bool(self.timeline.chequered_flag[self.timeline.step(self.frame)])
+
+    def next_frame(self):
+        if self.frame + 1 >= self.timeline.frame_count():
+            return False
+        self.load_frame(self.frame + 1)
+        return True
+
+    def seek(self, frame):
+        if frame >= self.timeline.frame_count():
+            self.load_frame(self.timeline.frame_count() - 1)
+            return False
+        self.load_frame(frame)
+        return True
+
+    def restore_keyframe(self, frame):
+        self.load_frame(frame)
+
+    def load_frame(self, frame):
+        timeline = self.timeline
+        step = timeline.step(frame)
+        self.frame = frame
+        self.session_progress = float(timeline.session_progress[step])
+        self.player_timestamp = float(timeline.player_timestamp[step])
+
+        self.cars = [CarInfo(*[getattr(timeline, name)[step, i].item() for name in CAR_FIELDS])
+                     for i in range(len(self.car_states))]
+        for i, car_state in enumerate(self.car_states):
+            car_state.progress = timeline.progress[step, i].item()
+            car_state.finished = bool(timeline.finished[step, i])
+            car_state.is_spinning = bool(timeline.is_spinning[step, i])
+
+        driver = int(timeline.fastest_lap_driver[step])
+        if driver < 0:
+            self.fastest_lap_info = None
+        else:
+            self.fastest_lap_info = FastestLapInfo(float(timeline.fastest_lap_timestamp[step]),
+                                                   float(timeline.fastest_lap_time[step]), driver)
@@ -1,3 +1,24 @@
+import bisect
+import collections
+import math
+
+import numpy as np
+
+# A car going slower than this fraction of the usual speed at its place on the track is spinning
+SPIN_SPEED_RATIO = 0.5
+MIN_SPIN_DURATION = 0.2
+# Spins that start this long after the car was in the pits, or end this long before it goes in, are the car
+# coming out of or going into the pits
+PIT_EXIT_WINDOW = 5
+PIT_ENTRY_WINDOW = 2
+# Samples a metre of track needs before SpinDetector trusts its average speed
+MIN_SPEED_SAMPLES = 3
+
+
+def track_buckets(lap_distance, track_length):
+    buckets = np.trunc(lap_distance).astype(np.int64)
+    # Negative distances index from the end, like the per-metre lists used to
+    return np.where(buckets < 0, buckets + track_length + 1, buckets)
 
 
 class RaceEvent:
@@ -17,6 +38,9 @@ class RaceEvent:
     def duration(self):
         return self.end_time - self.start_time
 
+    def end_or_infinity(self):
+        return math.inf if self.end_time is None else self.end_time
+
 
 class RaceEvents:
     def __init__(self, car_idx, min_duration = 0.0):
@@ -24,7 +48,30 @@ class RaceEvents:
         self.events = []
         self.min_duration = min_duration
 
+        # Sorted start/end times of the events, rebuilt on the first lookup after a change
+        self.starts = None
+        self.ends = None
+        # Lookups made with increasing timestamps walk forward from the previous result
+        self.cursor = 0
+        self.cursor_timestamp = -math.inf
+
+    def set_events(self, events):
+        self.events = events
+        self.starts = None
+
+    def add(self, event):
+        self.events.append(event)
+        self.starts = None
+
+    def build_index(self):
+        # Events never overlap, so both the start and end times are sorted
+        self.starts = [event.start_time for event in self.events]
+        self.ends = [event.end_or_infinity() for event in self.events]
+        self.cursor = 0
+        self.cursor_timestamp = -math.inf
+
     def record(self, timestamp, race_distance, is_happening):
+        self.starts = None
         if is_happening:
             if len(self.events) == 0 or not self.events[-1].is_happening():
                 self.events.append(RaceEvent(timestamp, race_distance))
@@ -34,102 +81,234 @@ class RaceEvents:
                 if self.events[-1].duration() < self.min_duration:
                     del self.events[-1]
 
+    @staticmethod
+    def from_flags(car_idx, timestamps, distances, flags, min_duration=0.0):
+        # Same events as calling record() for every sample, found with run-length detection on the flags
+        events = RaceEvents(car_idx, min_duration)
+        change = np.diff(np.concatenate(([0], flags.astype(np.int8))))
+        starts = np.flatnonzero(change == 1).tolist()
+        ends = np.flatnonzero(change == -1).tolist()
+        timestamps = timestamps.tolist()
+        distances = distances.tolist()
+        for i, start in enumerate(starts):
+            event = RaceEvent(timestamps[start], distances[start])
+            if i < len(ends):
+                event.end(timestamps[ends[i]], distances[ends[i]])
+                if event.duration() < min_duration:
+                    continue
+            events.events.append(event)
+        return events
+
     def is_happening(self, timestamp):
-        for event in self.events:
-            if event.start_time > timestamp:
-                return False
+        if self.starts is None:
+            self.build_index()
 
-            if event.end_time >= timestamp:
-                return True
+        # The first event that has not ended yet is the only one that can be happening
+        ends = self.ends
+        if timestamp >= self.cursor_timestamp:
+            while self.cursor < len(ends) and ends[self.cursor] < timestamp:
+                self.cursor += 1
+        else:
+            self.cursor = bisect.bisect_left(ends, timestamp)
+        self.cursor_timestamp = timestamp
+
+        return self.cursor < len(ends) and self.starts[self.cursor] <= timestamp
+
+    def is_happening_many(self, timestamps):
+        if self.starts is None:
+            self.build_index()
+
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        if len(self.events) == 0:
+            return np.zeros(timestamps.shape, dtype=bool)
+        starts = np.array(self.starts, dtype=np.float64)
+        indices = np.searchsorted(np.array(self.ends, dtype=np.float64), timestamps, side="left")
+        found = indices < len(starts)
+        return found & (starts[np.minimum(indices, len(starts) - 1)] <= timestamps)
 
 
 class TrackSpeed:
     def __init__(self, session):
-        track_length = session.get_track_length()
+        self.track_length = session.get_track_length()
         self.num_laps = session.get_number_of_laps()
-        self.bins = [0.0] * (track_length + 1)
-        self.counts = [0.0] * (track_length + 1)
+        self.bins = None
+        self.counts = None
 
         self.spins = None
         self.pits = None
 
         self.participants = session.get_participants_info()
+        self.active = np.array([p.is_active for p in self.participants])
 
-        self.compute_average_speed(session)
+        replay = session.get_race_replay(skip_formation_lap=True)
 
-        self.find_spins(session)
+        self.compute_average_speed(replay)
 
-    def compute_average_speed(self, session):
-        session.start_race_replay(True)
-        previous_position = session.get_current_race_position()
+        self.find_spins(replay)
 
-        while session.read_next_packet():
-            position = session.get_current_race_position()
-            if position is None:
-                continue
-            if previous_position is not None:
-                for i, car in enumerate(position):
-                    if not self.participants[i].is_active:
-                        continue
-                    if car.lap_number > 1 and car.lap_number < self.num_laps and car.pit_status == 0:
-                        # Compute speed
-                        previous = previous_position[i]
-                        delta_t = car.timestamp - previous.timestamp
-                        if delta_t > 0:
-                            speed = (car.lap_distance - previous.lap_distance) / (car.timestamp - previous.timestamp)
-                            bucket = int(car.lap_distance)
-                            self.bins[bucket] += speed
-                            self.counts[bucket] += 1
-            previous_position = position
-
-    def is_spin(self, car, previous):
-        delta_t = car.timestamp - previous.timestamp
-        if delta_t == 0:
-            return False
-        speed = (car.lap_distance - previous.lap_distance) / delta_t
-        bucket = int(car.lap_distance)
-        average_speed = self.bins[bucket] / self.counts[bucket]
-        return speed < average_speed * 0.5
+    @staticmethod
+    def speeds(replay):
+        # Speed of every car between consecutive packets, same as comparing each race position with the
+        # previous one during a replay
+        delta_t = np.diff(replay.timestamp)[:, np.newaxis]
+        delta_distance = np.diff(replay.lap_distance, axis=0)
+        moving = np.broadcast_to(delta_t != 0, delta_distance.shape)
+        speed = np.zeros(delta_distance.shape)
+        np.divide(delta_distance, delta_t, out=speed, where=moving)
+        return speed, delta_t
+
+    def buckets(self, lap_distance):
+        return track_buckets(lap_distance, self.track_length)
+
+    def compute_average_speed(self, replay):
+        speed, delta_t = self.speeds(replay)
+        lap_number = replay.lap_number[1:]
+        counted = self.active & (lap_number > 1) & (lap_number < self.num_laps) & (replay.pit_status[1:] == 0) \
+            & (delta_t > 0)
 
-    def find_spins(self, session):
-        session.start_race_replay(True)
-        previous_position = session.get_current_race_position()
+        # bincount accumulates in packet order, so the sums match adding up the speeds one packet at a time
+        buckets = self.buckets(replay.lap_distance[1:][counted])
+        self.bins = np.bincount(buckets, weights=speed[counted], minlength=self.track_length + 1)
+        self.counts = np.bincount(buckets, minlength=self.track_length + 1).astype(np.float64)
 
+    def is_spin(self, replay):
+        speed, delta_t = self.speeds(replay)
+        buckets = self.buckets(replay.lap_distance[1:])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            average_speed = self.bins[buckets] / self.counts[buckets]
+        return (delta_t != 0) & (speed < average_speed * SPIN_SPEED_RATIO)
+
+    def find_spins(self, replay):
         self.spins = []
         self.pits = []
-        for i in range(len(self.participants)):
-            self.spins.append(RaceEvents(i, 0.2))
-            self.pits.append(RaceEvents(i))
 
-        while session.read_next_packet():
-            position = session.get_current_race_position()
-            if position is None:
+        timestamps = replay.timestamp[1:]
+        distances = replay.total_distance[1:]
+        lap_number = replay.lap_number[1:]
+        is_pits = replay.pit_status[1:] != 0
+        in_race = (lap_number > 1) & (lap_number < self.num_laps)
+        is_spinning = self.is_spin(replay) & ~is_pits
+
+        for i in range(len(self.participants)):
+            if not self.active[i]:
+                self.spins.append(RaceEvents(i, MIN_SPIN_DURATION))
+                self.pits.append(RaceEvents(i))
                 continue
-            if previous_position is not None:
-                for i, car in enumerate(position):
-                    if not self.participants[i].is_active:
-                        continue
-                    is_pits = car.pit_status != 0
-                    self.pits[i].record(car.timestamp, car.total_distance, is_pits)
-                    if car.lap_number > 1 and car.lap_number < self.num_laps:
-                        # Compute speed
-                        is_spinning = self.is_spin(car, previous_position[i]) and not is_pits
-                        self.spins[i].record(car.timestamp, car.total_distance, is_spinning)
-            previous_position = position
+            self.pits.append(RaceEvents.from_flags(i, timestamps, distances[:, i], is_pits[:, i]))
+            recorded = in_race[:, i]
+            self.spins.append(RaceEvents.from_flags(i, timestamps[recorded], distances[recorded, i],
+                                                    is_spinning[recorded, i], MIN_SPIN_DURATION))
 
         # Clear 'spins' going in or coming out of pit stop
         for i in range(len(self.spins)):
             car_spins = self.spins[i]
             car_pits = self.pits[i]
 
-            for spin in car_spins.events:
-                if car_pits.is_happening(spin.start_time - 5) \
-                        or car_pits.is_happening(spin.end_time + 2) \
-                        or car_pits.is_happening(spin.start_time) \
-                        or car_pits.is_happening(spin.end_time):
-                    spin.end_time = spin.start_time
+            starts = np.array([spin.start_time for spin in car_spins.events], dtype=np.float64)
+            ends = np.array([spin.end_or_infinity() for spin in car_spins.events], dtype=np.float64)
+            near_pits = car_pits.is_happening_many(starts - PIT_EXIT_WINDOW) \
+                | car_pits.is_happening_many(ends + PIT_ENTRY_WINDOW) \
+                | car_pits.is_happening_many(starts) \
+                | car_pits.is_happening_many(ends)
+
+            car_spins.set_events([spin for spin, pits in zip(car_spins.events, near_pits.tolist())
+                                  if not pits and spin.start_time != spin.end_time])
+
+    def is_spinning(self, car, timestamp):
+        return self.spins[car].is_happening(timestamp)
+
+
+class SpinDetector:
+    # Finds spins like TrackSpeed, one race position at a time, for races that are still going on.  The usual
+    # speed at every metre of track is the average seen so far, so nothing is found until the first laps have
+    # been driven, and spins are only confirmed once the pit entry window after them is over.  Each race
+    # position costs the same, however long the race has been going.
+    def __init__(self, track_length, num_laps, active):
+        self.track_length = track_length
+        self.num_laps = num_laps
+        self.active = np.array(active, dtype=bool)
+        self.bins = np.zeros(track_length + 1)
+        self.counts = np.zeros(track_length + 1)
+        self.previous = None
+        self.latest_timestamp = None
+
+        num_cars = len(self.active)
+        self.spins = [RaceEvents(i, MIN_SPIN_DURATION) for i in range(num_cars)]
+        self.pits = [RaceEvents(i) for i in range(num_cars)]
+        # Spin each car is in, if any, and the spins that ended, waiting for their pit entry window, oldest first
+        self.current = [RaceEvents(i, MIN_SPIN_DURATION) for i in range(num_cars)]
+        self.pending = collections.deque()
+        self.spinning = np.zeros(num_cars, dtype=bool)
+        self.in_pits = np.zeros(num_cars, dtype=bool)
+
+    def add(self, race_position):
+        timestamp = race_position[0].timestamp
+        lap_number = np.array([car.lap_number for car in race_position])
+        lap_distance = np.array([car.lap_distance for car in race_position], dtype=np.float64)
+        total_distance = [car.total_distance for car in race_position]
+        in_pits = np.array([car.pit_status != 0 for car in race_position]) & self.active
 
-            car_spins.events = [e for e in car_spins.events if e.start_time != e.end_time]
+        previous = self.previous
+        self.previous = (timestamp, lap_distance)
+        self.latest_timestamp = timestamp
+        if previous is None:
+            return
+
+        for i in np.flatnonzero(in_pits != self.in_pits).tolist():
+            self.pits[i].record(timestamp, total_distance[i], in_pits[i])
+        self.in_pits = in_pits
+
+        delta_t = timestamp - previous[0]
+        buckets = track_buckets(lap_distance, self.track_length)
+        in_race = self.active & (lap_number > 1) & (lap_number < self.num_laps)
+        spinning = np.zeros(len(self.active), dtype=bool)
+        if delta_t != 0:
+            speed = (lap_distance - previous[1]) / delta_t
+            counts = self.counts[buckets]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                average_speed = self.bins[buckets] / counts
+            spinning = (counts >= MIN_SPEED_SAMPLES) & (speed < average_speed * SPIN_SPEED_RATIO) & ~in_pits
+
+        for i in np.flatnonzero(in_race & (spinning != self.spinning)).tolist():
+            current = self.current[i]
+            current.record(timestamp, total_distance[i], spinning[i])
+            if len(current.events) > 0 and not current.events[-1].is_happening():
+                self.pending.append((i, current.events.pop()))
+        self.spinning = np.where(in_race, spinning, self.spinning)
+
+        if delta_t > 0:
+            counted = in_race & ~in_pits
+            np.add.at(self.bins, buckets[counted], speed[counted])
+            np.add.at(self.counts, buckets[counted], 1)
+
+        while len(self.pending) > 0 and self.pending[0][1].end_time + PIT_ENTRY_WINDOW <= timestamp:
+            self.confirm(*self.pending.popleft())
+
+    def end(self):
+        # Confirms every spin left, once the race positions run out
+        while len(self.pending) > 0:
+            self.confirm(*self.pending.popleft())
+        for i, current in enumerate(self.current):
+            for spin in current.events:
+                self.confirm(i, spin)
+            current.set_events([])
+
+    def confirm(self, car, spin):
+        if spin.start_time != spin.end_time and not self.near_pits(car, spin.start_time, spin.end_or_infinity()):
+            self.spins[car].add(spin)
+
+    def near_pits(self, car, start, end):
+        pits = self.pits[car]
+        return any(pits.is_happening(timestamp)
+                   for timestamp in (start - PIT_EXIT_WINDOW, end + PIT_ENTRY_WINDOW, start, end))
 
     def is_spinning(self, car, timestamp):
         return self.spins[car].is_happening(timestamp)
+
+    def is_spinning_now(self, car):
+        # Spins are shown as soon as they last long enough, before they are confirmed
+        if len(self.current[car].events) == 0:
+            return False
+        start = self.current[car].events[0].start_time
+        return self.latest_timestamp - start >= MIN_SPIN_DURATION \
+            and not self.near_pits(car, start, self.latest_timestamp)
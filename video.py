@@ -1,21 +1,326 @@
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+from multiprocessing import shared_memory
+
 import cv2
 import numpy as np
 import pygame
 
+from canvas import FrameCanvas
+# Frames that can be waiting to be encoded before the renderer has to wait for the encoder
+ENCODER_SLOTS = 8
+# Queued instead of a frame slot when the frame is the same as the previous one
+REPEAT_FRAME = -1
 
-class VideoWriter:
+
+def pixel_conversion(surface):
+    # OpenCV conversion from the surface's pixel memory to BGR, None if the surface is not 32 bits per pixel
+    # with 8 bits per color channel
+    if surface.get_bytesize() != 4:
+        return None
+    offsets = []
+    for shift, mask in zip(surface.get_shifts()[:3], surface.get_masks()[:3]):
+        if mask != 0xff << shift or shift % 8 != 0:
+            return None
+        offset = shift // 8
+        offsets.append(offset if sys.byteorder == "little" else 3 - offset)
+    if offsets == [2, 1, 0]:
+        return cv2.COLOR_BGRA2BGR
+    if offsets == [0, 1, 2]:
+        return cv2.COLOR_RGBA2BGR
+    return None
+
+
+def convert_frame(surface, frame):
+    # Writes the surface pixels into frame, a (height, width, 3) BGR array
+    if isinstance(surface, FrameCanvas):
+        np.copyto(frame, surface.frame)
+        return
+    conversion = pixel_conversion(surface)
+    height, width = frame.shape[:2]
+    if conversion is None:
+        array = np.frombuffer(pygame.image.tostring(surface, "RGB"), dtype=np.uint8)
+        array.shape = (height, width, 3)
+        cv2.cvtColor(array, cv2.COLOR_RGB2BGR, dst=frame)
+    else:
+        # Read the pixels where they are, the surface stays locked while the buffer is referenced
+        buffer = surface.get_buffer()
+        pixels = np.frombuffer(buffer, dtype=np.uint8).reshape(height, surface.get_pitch())
+        pixels = pixels[:, :width * 4].reshape(height, width, 4)
+        cv2.cvtColor(pixels, conversion, dst=frame)
+        del pixels, buffer
+
+
+class OpenCVEncoder:
     def __init__(self, output, width, height, fps):
-        self.width = width
-        self.height = height
         fourcc = cv2.VideoWriter_fourcc(*'DIVX')  # Be sure to use lower case
         self.out = cv2.VideoWriter(output, fourcc, fps, (width, height))
+        if not self.out.isOpened():
+            raise IOError(f"cannot open {output} for writing")
+
+    def write(self, frame):
+        self.out.write(frame)
+
+    def repeat(self, frame):
+        self.out.write(frame)
+
+    def release(self):
+        self.out.release()
+
+
+class FFmpegEncoder:
+    # Streams raw BGR frames to an ffmpeg process, which encodes them with any codec it supports
+    def __init__(self, output, width, height, fps, codec, preset, crf):
+        ffmpeg = shutil.which("ffmpeg")
+        if ffmpeg is None:
+            raise IOError("ffmpeg not found")
+        self.output = output
+        self.process = subprocess.Popen([ffmpeg, "-y", "-loglevel", "error",
+                                         "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}",
+                                         "-r", str(fps), "-i", "-",
+                                         "-c:v", codec, "-preset", preset, "-crf", str(crf),
+                                         "-pix_fmt", "yuv420p", output],
+                                        stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        try:
+            self.process.stdin.write(frame.data)
+        except BrokenPipeError:
+            self.release()
+
+    def repeat(self, frame):
+        self.write(frame)
+
+    def release(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        status = self.process.wait()
+        if status != 0:
+            raise IOError(f"ffmpeg failed to encode {self.output}, exit status {status}")
+
+
+class ImageSequenceEncoder:
+    # Writes every frame to its own file in the output directory, as PNG or as raw BGR bytes.  Frame numbers
+    # start at first_frame, so parallel renders can write to the same directory.
+    def __init__(self, output, image_format, first_frame):
+        os.makedirs(output, exist_ok=True)
+        self.output = output
+        self.image_format = image_format
+        self.frame_number = first_frame
+
+    def write(self, frame):
+        filename = self.filename(self.frame_number)
+        if self.image_format == "png":
+            if not cv2.imwrite(filename, frame):
+                raise IOError(f"cannot write {filename}")
+        else:
+            frame.tofile(filename)
+        self.frame_number += 1
+
+    def repeat(self, frame):
+        # Copies the previous file instead of encoding the image again
+        shutil.copyfile(self.filename(self.frame_number - 1), self.filename(self.frame_number))
+        self.frame_number += 1
+
+    def filename(self, frame_number):
+        return os.path.join(self.output, f"frame{frame_number:06d}.{self.image_format}")
+
+    def release(self):
+        pass
+
+
+class NullEncoder:
+    # Throws the frames away, for measuring rendering speed
+    def write(self, frame):
+        pass
+
+    def repeat(self, frame):
+        pass
+
+    def release(self):
+        pass
+
+
+class EncoderSettings:
+    NAMES = ["opencv", "ffmpeg", "png", "raw", "null"]
+
+    def __init__(self, name="opencv", codec="libx264", preset="medium", crf=20):
+        if name not in self.NAMES:
+            raise ValueError(f"unknown encoder {name}")
+        self.name = name
+        self.codec = codec
+        self.preset = preset
+        self.crf = crf
+
+    def writes_video_file(self):
+        return self.name in ["opencv", "ffmpeg"]
+
+    def open(self, output, width, height, fps, first_frame=0):
+        if self.name == "opencv":
+            return OpenCVEncoder(output, width, height, fps)
+        if self.name == "ffmpeg":
+            return FFmpegEncoder(output, width, height, fps, self.codec, self.preset, self.crf)
+        if self.name in ["png", "raw"]:
+            return ImageSequenceEncoder(output, self.name, first_frame)
+        return NullEncoder()
+
+
+class VideoWriter:
+    def __init__(self, output, width, height, fps, encoder=None, first_frame=0):
+        self.width = width
+        self.height = height
+        if encoder is None:
+            encoder = EncoderSettings()
+        self.out = encoder.open(output, width, height, fps, first_frame)
+        # Every frame is converted into the same buffer
+        self.frame = np.empty((height, width, 3), dtype=np.uint8)
+        self.last_frame = None
 
     def export_frame(self, surface):
-        frame = pygame.image.tostring(surface, "RGB")
-        array = np.frombuffer(frame, dtype=np.uint8)
-        array.shape = (self.height, self.width, 3)
-        cvt = cv2.cvtColor(array, cv2.COLOR_RGB2BGR)
-        self.out.write(cvt)
+        if isinstance(surface, FrameCanvas):
+            # Already drawn as a BGR frame
+            self.last_frame = surface.frame
+        else:
+            convert_frame(surface, self.frame)
+            self.last_frame = self.frame
+        self.out.write(self.last_frame)
+
+    def repeat_frame(self):
+        # Writes the last exported frame again, for a surface that has not changed since
+        self.out.repeat(self.last_frame)
 
     def close(self):
-        self.out.release()
\ No newline at end of file
+        self.out.release()
+
+
+class BackgroundVideoWriter:
+    # Same as VideoWriter, but the frames are encoded by another process.  Frames are handed over through a ring of
+    # frame buffers in shared memory: the renderer fills a free slot and queues its index, the encoder writes it
+    # out and frees the slot.  When every slot is waiting to be encoded the renderer waits.  The last frame written
+    # keeps its slot until the next one, for repeats, so at least two slots are needed.
+    def __init__(self, output, width, height, fps, encoder=None, first_frame=0, slots=ENCODER_SLOTS):
+        if slots < 2:
+            raise ValueError("at least two frame slots are needed")
+        self.width = width
+        self.height = height
+        self.slots = slots
+        self.next_slot = 0
+        shape = (slots, height, width, 3)
+        self.memory = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+        self.frames = np.ndarray(shape, dtype=np.uint8, buffer=self.memory.buf)
+
+        context = multiprocessing.get_context("spawn")
+        self.free_slots = context.Semaphore(slots)
+        self.filled_slots = context.Queue()
+        self.result = context.Queue()
+        self.process = context.Process(target=encode_frames,
+                                       args=(self.memory.name, shape, output, fps, encoder or EncoderSettings(),
+                                             first_frame, self.filled_slots, self.free_slots, self.result),
+                                       daemon=True)
+        self.process.start()
+
+    def export_frame(self, surface):
+        while not self.free_slots.acquire(timeout=1):
+            if not self.process.is_alive():
+                self.close()
+        convert_frame(surface, self.frames[self.next_slot])
+        self.filled_slots.put(self.next_slot)
+        self.next_slot = (self.next_slot + 1) % self.slots
+
+    def repeat_frame(self):
+        self.filled_slots.put(REPEAT_FRAME)
+
+    def close(self):
+        if self.memory is None:
+            return
+        if self.process.is_alive():
+            self.filled_slots.put(None)
+        self.process.join()
+        error = self.result.get() if not self.result.empty() else "encoder process exited unexpectedly"
+        del self.frames
+        self.memory.close()
+        self.memory.unlink()
+        self.memory = None
+        if error is not None:
+            raise RuntimeError(f"Video encoding failed: {error}")
+
+
+def export_frames(renderers, video_outs):
+    # Writes the current frame of every renderer to its own video, returns the rects each renderer changed
+    changed_rects = []
+    for renderer, video_out in zip(renderers, video_outs):
+        rects = renderer.update_changes()
+        # Frames where nothing moved, like before the start and after the finish, are not drawn or converted again
+        if rects:
+            video_out.export_frame(renderer.display_surface)
+        else:
+            video_out.repeat_frame()
+        changed_rects.append(rects)
+    return changed_rects
+
+
+def encode_frames(memory_name, shape, output, fps, encoder, first_frame, filled_slots, free_slots, result):
+    # Runs in the encoder process started by BackgroundVideoWriter
+    memory = shared_memory.SharedMemory(name=memory_name)
+    frames = np.ndarray(shape, dtype=np.uint8, buffer=memory.buf)
+    error = None
+    try:
+        out = encoder.open(output, shape[2], shape[1], fps, first_frame)
+        try:
+            last_slot = None
+            slot = filled_slots.get()
+            while slot is not None:
+                if slot == REPEAT_FRAME:
+                    out.repeat(frames[last_slot])
+                else:
+                    out.write(frames[slot])
+                    if last_slot is not None:
+                        free_slots.release()
+                    last_slot = slot
+                slot = filled_slots.get()
+        finally:
+            out.release()
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    del frames
+    memory.close()
+    result.put(error)
+
+
+def concatenate(segments, output):
+    # Joins video files with identical encoding settings.  ffmpeg copies the encoded streams as they are,
+    # without it the frames have to be decoded and encoded again.
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is not None:
+        list_file = f"{output}.segments.txt"
+        with open(list_file, "w") as file:
+            for segment in segments:
+                escaped = os.path.abspath(segment).replace("'", "'\\''")
+                file.write(f"file '{escaped}'\n")
+        try:
+            subprocess.run([ffmpeg, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_file,
+                            "-c", "copy", output], check=True)
+        finally:
+            os.remove(list_file)
+        return
+
+    print("ffmpeg not found, re-encoding the video segments")
+    out = None
+    for segment in segments:
+        capture = cv2.VideoCapture(segment)
+        if out is None:
+            fourcc = cv2.VideoWriter_fourcc(*'DIVX')
+            size = (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+            out = cv2.VideoWriter(output, fourcc, capture.get(cv2.CAP_PROP_FPS), size)
+        ok, frame = capture.read()
+        while ok:
+            out.write(frame)
+            ok, frame = capture.read()
+        capture.release()
+    if out is not None:
+        out.release()
@@ -1,43 +1,128 @@
+import argparse
 import pygame.locals
 import sys
-import state
+import parallel
 import render
 import video
-from session import Session
 
 from render import WINDOW_HEIGHT, WINDOW_WIDTH, FPS, SECONDS_PER_LAP, START_FRAME
 
-VIDEO_OUT="/Users/dneto/dev/raceviewer/video.avi"
+VIDEO_OUT="video.avi"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Render an F1 2020 race recording to video.")
+    parser.add_argument("session", help="SQLite3 file recorded from the game's telemetry")
+    parser.add_argument("--names", default=None, help="file with one driver name per line")
+    parser.add_argument("--output", default=VIDEO_OUT,
+                        help=f"output video file, or directory for image sequences (default: {VIDEO_OUT})")
+    parser.add_argument("--encoder", choices=video.EncoderSettings.NAMES, default="opencv",
+                        help="opencv writes DIVX AVI files, ffmpeg pipes the frames to the ffmpeg command, png and raw "
+                             "write one file per frame, null discards the frames (default: opencv)")
+    parser.add_argument("--codec", default="libx264", help="ffmpeg video codec (default: libx264)")
+    parser.add_argument("--preset", default="medium", help="ffmpeg encoding preset (default: medium)")
+    parser.add_argument("--crf", type=int, default=20, help="ffmpeg constant rate factor (default: 20)")
+    parser.add_argument("--width", type=int, default=WINDOW_WIDTH, help=f"video width (default: {WINDOW_WIDTH})")
+    parser.add_argument("--height", type=int, default=WINDOW_HEIGHT, help=f"video height (default: {WINDOW_HEIGHT})")
+    parser.add_argument("--fps", type=int, default=FPS, help=f"frames per second (default: {FPS})")
+    parser.add_argument("--seconds-per-lap", type=int, default=SECONDS_PER_LAP,
+                        help=f"video seconds for each race lap (default: {SECONDS_PER_LAP})")
+    parser.add_argument("--start-frame", type=int, default=START_FRAME,
+                        help="race frame the replay starts at, skipping the laps before it.  The cars start without "
+                             "their animations, use --first-frame to render the end of the full replay instead")
+    parser.add_argument("--first-frame", type=int, default=0,
+                        help="first frame to write, the replay runs up to it without drawing so the animations look "
+                             "the same as in a full render (default: 0)")
+    parser.add_argument("--last-frame", type=int, default=None,
+                        help="last frame to write (default: until the race is over)")
+    parser.add_argument("--headless", action="store_true",
+                        help="render without a window, as fast as possible")
+    parser.add_argument("--background-encoder", action="store_true",
+                        help="encode the video in another process, while the next frames are rendered")
+    parser.add_argument("--timeline", default=None,
+                        help="file with the precomputed race timeline, created if missing or out of date")
+    parser.add_argument("--backend", choices=render.BACKENDS, default="pygame",
+                        help="numpy draws straight into the video frames without SDL, implies --headless "
+                             "(default: pygame)")
+    parser.add_argument("--extra-output", nargs=3, action="append", default=[],
+                        metavar=("OUTPUT", "WIDTH", "HEIGHT"),
+                        help="also render the video at another size, from the same replay (can be repeated)")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="render frame ranges in this many processes, implies --headless (default: 1)")
+    args = parser.parse_args()
+    if args.last_frame is not None and args.last_frame < args.first_frame:
+        parser.error("--last-frame is before --first-frame")
+    return args
 
-SESSION_FILE="/Users/dneto/dev/raceview/raceviewer/F1_2019_14cc77fd5922e307.sqlite3"
-# SESSION_FILE="/Users/dneto/dev/raceviewer/F1_2019_e9444ba7f05db735.sqlite3"
-NAMES_FILE=None
 
 def run():
-    # session.Session("/Users/dneto/dev/raceviewer/F1_2019_e9444ba7f05db735.sqlite3", "/Users/dneto/dev/raceviewer/driver_names.txt")
-    session = Session(SESSION_FILE, NAMES_FILE)
-    game_state = state.GameState(session, FPS, SECONDS_PER_LAP, START_FRAME)
-    renderer = render.Renderer("Race Viewer", game_state)
-    video_out = video.VideoWriter(VIDEO_OUT, WINDOW_WIDTH, WINDOW_HEIGHT, FPS)
+    args = parse_args()
+    encoder = video.EncoderSettings(args.encoder, args.codec, args.preset, args.crf)
+    extra_sizes = [(int(width), int(height)) for output, width, height in args.extra_output]
+    outputs = [args.output] + [output for output, width, height in args.extra_output]
+    job = parallel.RenderJob(args.session, args.names, args.width, args.height, args.fps,
+                             args.seconds_per_lap, args.start_frame, args.timeline, encoder, args.backend, extra_sizes)
+    end_frame = None if args.last_frame is None else args.last_frame + 1
+    if args.jobs > 1:
+        parallel.render_parallel(job, outputs, args.jobs, args.first_frame, end_frame)
+        return
+
+    headless = args.headless or args.backend == "numpy"
+    game_state = job.create_state()
+    # Only the first output is shown in the window, the others are always rendered offscreen
+    renderers = [render.Renderer("Race Viewer", game_state, headless or i > 0, args.backend, render.Layout(width, height))
+                 for i, (width, height) in enumerate(job.sizes())]
+    if not render.seek_renderers(renderers, args.first_frame):
+        pygame.quit()
+        sys.exit(f"The race is over before frame {args.first_frame}")
+    video_outs = []
+    for output, (width, height) in zip(outputs, job.sizes()):
+        if args.background_encoder:
+            video_outs.append(video.BackgroundVideoWriter(output, width, height, args.fps, encoder, args.first_frame))
+        else:
+            video_outs.append(video.VideoWriter(output, width, height, args.fps, encoder, args.first_frame))
+
+    if headless:
+        run_headless(game_state, renderers, video_outs, end_frame)
+    else:
+        run_window(game_state, renderers, video_outs, args.fps, end_frame)
+
+
+def close(video_outs):
+    for video_out in video_outs:
+        video_out.close()
+
+
+def run_headless(game_state, renderers, video_outs, end_frame=None):
+    while True:
+        video.export_frames(renderers, video_outs)
+        if not game_state.next_frame() or game_state.frame == end_frame:
+            break
+    close(video_outs)
+    pygame.quit()
+
 
+def run_window(game_state, renderers, video_outs, fps, end_frame=None):
     clock = pygame.time.Clock()
 
     while True:
         for event in pygame.event.get():
             if event.type == pygame.locals.QUIT:
                 pygame.quit()
-                video_out.close()
+                close(video_outs)
                 sys.exit()
+            if event.type == pygame.locals.VIDEOEXPOSE:
+                pygame.display.update()
 
-        renderer.update()
-        video_out.export_frame(renderer.display_surface)
-        pygame.display.update()
-        clock.tick(FPS)
-        if not game_state.next_frame():
+        # Only the parts of the window that changed are redrawn and sent to the screen
+        changed_rects = video.export_frames(renderers, video_outs)[0]
+        pygame.display.update(changed_rects)
+        clock.tick(fps)
+        if not game_state.next_frame() or game_state.frame == end_frame:
             pygame.quit()
-            video_out.close()
+            close(video_outs)
             sys.exit()
 
 
 if __name__ == "__main__":
-    run()
\ No newline at end of file
+    run()